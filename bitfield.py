@@ -4,6 +4,8 @@ import random
 
 # Manager for bitfield as a byte array, helper to work with bitfield.
 class Bitfield:
+    __slots__ = ("field", "num_pieces")
+
     def __init__(self, num_pieces):
 
         num_bytes = math.ceil(num_pieces / 8)
@@ -32,6 +34,13 @@ class Bitfield:
         mask = 128 >> bit_index_in_byte
         self.field[byte_index] |= mask  # Help GPT
 
+    def clear_piece(self, piece_index):
+        if piece_index >= self.num_pieces:
+            raise IndexError("Piece index out of bounds")
+
+        mask = 128 >> (piece_index % 8)
+        self.field[piece_index // 8] &= ~mask & 0xFF
+
     # Checks for pieces
     def has_piece(self, piece_index):
         if piece_index >= self.num_pieces:
@@ -46,7 +55,8 @@ class Bitfield:
 
     def set_all(self):
 
-        self.field = bytearray([255] * len(self.field))
+        # in place, field may be a view on shared memory (see over())
+        self.field[:] = bytes([255] * len(self.field))
 
         # claer any spare bits at the end
         spare_bits = (len(self.field) * 8) - self.num_pieces
@@ -67,6 +77,17 @@ class Bitfield:
         bitfield.field = bytearray(byte_data)
         return bitfield
 
+    # Bitfield on top of an existing writable buffer (e.g. a memoryview on
+    # shared memory) instead of its own bytearray. Contents are kept.
+    @classmethod
+    def over(cls, num_pieces, buffer):
+        bitfield = cls.__new__(cls)
+        if len(buffer) != math.ceil(num_pieces / 8):
+            raise ValueError("Invalid bitfield buffer length")
+        bitfield.field = buffer
+        bitfield.num_pieces = num_pieces
+        return bitfield
+
     def has_interesting_pieces(self, their_bitfield):
         # We need to check byte by byte (GPT clutch)
         for i in range(len(self.field)):
@@ -81,25 +102,59 @@ class Bitfield:
                 return True
         return False
 
-    # See spec, piece from other file is selected randomly.
-    def select_random_piece(self, their_bitfield, requested_pieces):
-        interesting_pieces = []
-        for i in range(self.num_pieces):
-
-            # Check if they have it (1), we don't (0), and we're not
-            # already downloading it.
-            we_have_file = their_bitfield.has_piece(i)
-            they_do_not_have_file = not self.has_piece(i)
-            we_not_dowloading_file = i not in requested_pieces
+    # Number of pieces set.
+    def count(self):
+        return sum(bin(byte).count("1") for byte in self.field)
 
-            if we_have_file and they_do_not_have_file and we_not_dowloading_file:
-                interesting_pieces.append(i)
+    # Number of pieces in their_bitfield that we do not have.
+    def count_interesting_pieces(self, their_bitfield):
+        count = 0
+        for i in range(len(self.field)):
+            count += bin(their_bitfield.field[i] & ~self.field[i] & 0xFF).count("1")
+        return count
+
+    # Pieces they have, we lack and are not downloading, in index order.
+    # Goes byte by byte so bytes with nothing new are skipped in one step.
+    # Stops after limit pieces (None for all).
+    def _candidates(self, their_bitfield, requested_pieces, limit=None):
+        candidates = []
+        field = self.field
+        for byte_index, their_byte in enumerate(their_bitfield.field):
+            # bits they have (1) and we don't (0)
+            wanted = their_byte & ~field[byte_index] & 0xFF
+            if not wanted:
+                continue
+            base = byte_index * 8
+            for bit in range(8):
+                piece_index = base + bit
+                if (
+                    wanted & (128 >> bit)
+                    and piece_index < self.num_pieces
+                    and piece_index not in requested_pieces
+                ):
+                    candidates.append(piece_index)
+                    if limit is not None and len(candidates) >= limit:
+                        return candidates
+        return candidates
 
+    # See spec, piece from other file is selected randomly.
+    def select_random_piece(self, their_bitfield, requested_pieces):
+        interesting_pieces = self._candidates(their_bitfield, requested_pieces)
         if not interesting_pieces:
             return None
 
         return random.choice(interesting_pieces)
 
+    # Streaming mode: lowest pieces first. One of the first `window`
+    # candidates is taken at random, so connections downloading at the same
+    # time do not all ask for the same piece.
+    def select_sequential_piece(self, their_bitfield, requested_pieces, window=1):
+        candidates = self._candidates(their_bitfield, requested_pieces, window)
+        if not candidates:
+            return None
+
+        return random.choice(candidates)
+
     def __str__(self):
         s = ""
         for byte in self.field:
@@ -0,0 +1,258 @@
+import math
+from array import array
+
+from peer import Peer
+
+# Config file loading.
+#
+# Both files are read line by line with str.split, nothing is kept per line
+# but what is needed. PeerInfo.cfg goes into a PeerInfoIndex (columns plus a
+# dict from peer id to row) instead of a list of Peer objects, so a 10k+ peer
+# file loads quickly and a peer finds its own entry with one lookup.
+#
+# Every problem is raised as ConfigError (with file and line), so the caller
+# can report it and exit before opening any socket.
+
+# PieceSize is optional, see resolve_piece_size
+REQUIRED_COMMON_KEYS = (
+    "NumberOfPreferredNeighbors",
+    "UnchokingInterval",
+    "OptimisticUnchokingInterval",
+    "FileName",
+    "FileSize",
+)
+POSITIVE_COMMON_KEYS = (
+    "UnchokingInterval",
+    "OptimisticUnchokingInterval",
+    "FileSize",
+)
+
+# automatic piece size bounds: pieces are never smaller than 16 KiB
+# (unless the whole file is), and never bigger than 16 MiB
+MIN_PIECE_SIZE = 1 << 14
+MAX_PIECE_SIZE = 1 << 24
+PIECES_PER_PEER = 16
+MIN_PIECES = 64
+MAX_PIECES = 4096  # 512 byte bitfield
+
+# Optional keys, checked here as well so --check reports everything that
+# would otherwise only fail at startup. Numbers are (key, type, positive):
+# positive keys must be > 0, the others >= 0.
+OPTIONAL_NUMBER_KEYS = (
+    ("MaxUploadRate", int, False),
+    ("MaxDownloadRate", int, False),
+    ("MaxUploadRatePerPeer", int, False),
+    ("MaxDownloadRatePerPeer", int, False),
+    ("KeepAliveInterval", int, True),
+    ("IdleTimeout", int, True),
+    ("RequestTimeout", int, True),
+    ("ConnectParallelism", int, True),
+    ("ConnectTimeout", float, True),
+    ("ConnectRetries", int, False),
+    ("ConnectBackoff", float, False),
+    ("ConnectBackoffMax", float, False),
+    ("HaveBatchDelay", float, False),
+    ("Workers", int, False),
+    ("SequentialWindow", int, True),
+    ("TargetConnections", int, False),
+    ("PexInterval", float, True),
+    ("PexMaxPeers", int, False),
+    ("PexMaxConnections", int, False),
+    ("SampleInterval", float, False),
+    ("SuperSeedPatience", int, True),
+    ("SuperSeedOffers", int, True),
+)
+
+PIECE_SELECTIONS = ("random", "sequential")
+PREALLOCATIONS = ("sparse", "full", "none")
+FSYNC_POLICIES = ("always", "batch", "none")
+SEED_CHOKINGS = ("random", "upload")
+SWITCHES = ("0", "1")
+OPTIONAL_CHOICE_KEYS = (
+    ("PieceSelection", PIECE_SELECTIONS),
+    ("Preallocation", PREALLOCATIONS),
+    ("FsyncPolicy", FSYNC_POLICIES),
+    ("SeedChoking", SEED_CHOKINGS),
+    ("Pex", SWITCHES),
+    ("SuperSeeding", SWITCHES),
+    ("Profile", SWITCHES),
+)
+
+
+class ConfigError(ValueError):
+    pass
+
+
+def read_common_config(path):
+    config = {}
+    try:
+        with open(path, "r") as f:
+            for line_number, line in enumerate(f, 1):
+                fields = line.split()
+                if not fields:
+                    continue
+                if len(fields) < 2:
+                    raise ConfigError(
+                        f"{path}:{line_number}: {fields[0]} has no value."
+                    )
+                config[fields[0]] = fields[1]
+    except FileNotFoundError:
+        raise ConfigError(f"{path} not found.")
+    validate_common_config(config, path)
+    return config
+
+
+def validate_common_config(config, path="config"):
+    missing = [key for key in REQUIRED_COMMON_KEYS if key not in config]
+    if missing:
+        raise ConfigError(f"{path}: missing {', '.join(missing)}.")
+    for key in REQUIRED_COMMON_KEYS:
+        if key == "FileName":
+            continue
+        try:
+            value = int(config[key])
+        except ValueError:
+            raise ConfigError(f"{path}: {key} must be an integer, got {config[key]}.")
+        if key in POSITIVE_COMMON_KEYS and value <= 0:
+            raise ConfigError(f"{path}: {key} must be positive, got {value}.")
+        if value < 0:
+            raise ConfigError(f"{path}: {key} must not be negative, got {value}.")
+
+    piece_size = config.get("PieceSize", "auto")
+    if piece_size != "auto":
+        if not piece_size.isdigit() or int(piece_size) <= 0:
+            raise ConfigError(
+                f"{path}: PieceSize must be a positive integer or auto, got {piece_size}."
+            )
+
+    for key, number_type, positive in OPTIONAL_NUMBER_KEYS:
+        if key not in config:
+            continue
+        try:
+            value = number_type(config[key])
+        except ValueError:
+            kind = "an integer" if number_type is int else "a number"
+            raise ConfigError(f"{path}: {key} must be {kind}, got {config[key]}.")
+        if positive and not value > 0:
+            raise ConfigError(f"{path}: {key} must be positive, got {config[key]}.")
+        if not value >= 0:
+            raise ConfigError(f"{path}: {key} must not be negative, got {config[key]}.")
+
+    for key, choices in OPTIONAL_CHOICE_KEYS:
+        if key in config and config[key] not in choices:
+            raise ConfigError(
+                f"{path}: {key} must be one of {', '.join(choices)}, got {config[key]}."
+            )
+
+    # the shared table in multi-process mode only has rows for the peers in
+    # the peer info file, a tracker brings in others
+    if "Tracker" in config and int(config.get("Workers", 0)) > 0:
+        raise ConfigError(f"{path}: Tracker can not be used together with Workers.")
+
+
+# Picks a piece size when PieceSize is missing or auto: a power of two that
+# gives about PIECES_PER_PEER pieces per peer (within MIN_PIECES and
+# MAX_PIECES), clamped to MIN_PIECE_SIZE / MAX_PIECE_SIZE, and a single
+# piece for files smaller than that. Every peer must arrive at the same
+# value (it is checked in the handshake), so this only depends on FileSize
+# and the number of peers in the peer info file. num_peers None (unknown, the
+# swarm changes) aims for MAX_PIECES.
+def choose_piece_size(file_size, num_peers):
+    if num_peers is None:
+        target_pieces = MAX_PIECES
+    else:
+        target_pieces = min(MAX_PIECES, max(MIN_PIECES, PIECES_PER_PEER * num_peers))
+    piece_size = 1 << max(0, math.ceil(math.log2(file_size / target_pieces)))
+    piece_size = min(MAX_PIECE_SIZE, max(MIN_PIECE_SIZE, piece_size))
+    return min(piece_size, file_size)
+
+
+# Replaces a missing / auto PieceSize in config by the chosen one.
+# Returns True if it was chosen automatically. With a tracker the peer info
+# file is optional and differs between peers, only FileSize is used then.
+def resolve_piece_size(config, num_peers):
+    if config.get("PieceSize", "auto") != "auto":
+        return False
+    if "Tracker" in config:
+        num_peers = None
+    config["PieceSize"] = str(choose_piece_size(int(config["FileSize"]), num_peers))
+    return True
+
+
+# PeerInfo.cfg as columns, in file order. Iterating yields Peer objects,
+# which are only built when asked for.
+class PeerInfoIndex:
+
+    __slots__ = ("peer_ids", "hosts", "ports", "has_file", "row_of")
+
+    def __init__(self):
+        self.peer_ids = array("q")
+        self.hosts = []
+        self.ports = array("H")
+        self.has_file = bytearray()
+        self.row_of = {}  # peer id -> row
+
+    def add(self, peer_id, host, port, has_file):
+        if peer_id in self.row_of:
+            raise ConfigError(f"Peer {peer_id} is listed twice.")
+        self.row_of[peer_id] = len(self.peer_ids)
+        self.peer_ids.append(peer_id)
+        self.hosts.append(host)
+        self.ports.append(port)
+        self.has_file.append(has_file)
+
+    def __len__(self):
+        return len(self.peer_ids)
+
+    def __contains__(self, peer_id):
+        return peer_id in self.row_of
+
+    def __iter__(self):
+        for row in range(len(self.peer_ids)):
+            yield self._peer(row)
+
+    def get(self, peer_id):
+        row = self.row_of.get(peer_id)
+        return None if row is None else self._peer(row)
+
+    # the peers listed before peer_id (the ones it connects to)
+    def before(self, peer_id):
+        return [self._peer(row) for row in range(self.row_of[peer_id])]
+
+    def _peer(self, row):
+        return Peer(
+            self.peer_ids[row],
+            self.hosts[row],
+            self.ports[row],
+            self.has_file[row],
+        )
+
+
+# required=False returns an empty index for a missing file (tracker mode).
+def read_peer_info(path, required=True):
+    index = PeerInfoIndex()
+    hosts = {}  # many peers share a host, keep one string per host
+    try:
+        with open(path, "r") as f:
+            for line_number, line in enumerate(f, 1):
+                fields = line.split()
+                if not fields:
+                    continue
+                try:
+                    if len(fields) < 4:
+                        raise ValueError("expected [id] [host] [port] [has file?]")
+                    peer_id = int(fields[0])
+                    port = int(fields[2])
+                    has_file = int(fields[3])
+                    if not 0 < port < 65536:
+                        raise ValueError(f"bad port {port}")
+                    if has_file not in (0, 1):
+                        raise ValueError(f"has file must be 0 or 1, got {has_file}")
+                    host = hosts.setdefault(fields[1], fields[1])
+                    index.add(peer_id, host, port, has_file)
+                except ValueError as e:
+                    raise ConfigError(f"{path}:{line_number}: {e}")
+    except FileNotFoundError:
+        if required:
+            raise ConfigError(f"{path} not found.")
+    return index
@@ -0,0 +1,153 @@
+import random
+import socket
+import threading
+import time
+
+from logger import log_connect_result, log_connect_phase_done
+
+
+# Opens the outbound connections (to the peers listed before us).
+#
+# Every peer gets its own dial thread, but at most ConnectParallelism
+# connect() calls run at once. Failed attempts are retried with exponential
+# backoff (plus jitter) up to ConnectRetries times in a row, and a dropped
+# connection is dialed again the same way until shutdown or until the peer is
+# retired (it left the swarm, see tracker_client.py).
+#
+# start_handler(sock, peer) must start a ConnectionHandler and return it.
+# A peer whose handler ended up incompatible (e.g. other piece size) is never
+# dialed again, also not when the tracker or PEX hands it to us once more.
+class PeerConnector:
+    def __init__(
+        self, my_peer_id, common_config, start_handler, shutdown_event, local_testing
+    ):
+        self.my_peer_id = my_peer_id
+        self.start_handler = start_handler
+        self.shutdown_event = shutdown_event
+        self.local_testing = local_testing
+
+        self.connect_timeout = float(common_config.get("ConnectTimeout", 5))
+        self.max_retries = int(common_config.get("ConnectRetries", 5))
+        self.backoff_base = float(common_config.get("ConnectBackoff", 1))
+        self.backoff_max = float(common_config.get("ConnectBackoffMax", 30))
+        parallelism = int(common_config.get("ConnectParallelism", 16))
+        self.connect_slots = threading.BoundedSemaphore(max(1, parallelism))
+
+        # initial connect phase bookkeeping, for the timeline in the log
+        self.phase_lock = threading.Lock()
+        self.phase_start = None
+        self.phase_pending = 0
+        self.phase_connected = 0
+        self.phase_total = 0
+
+        # peer id -> token of its running dial thread
+        self.dialing = {}
+        self.dialing_lock = threading.Lock()
+        self.incompatible_ids = set()
+
+    # Returns right away, the connect phase runs in the background.
+    def connect_all(self, peers):
+        self.phase_start = time.monotonic()
+        self.phase_pending = self.phase_total = len(peers)
+        if not peers:
+            log_connect_phase_done(self.my_peer_id, 0, 0, 0.0)
+        for peer in peers:
+            self.connect(peer, initial=True)
+
+    # Starts dialing a peer found later on, no-op if it is already dialed.
+    def connect(self, peer, initial=False):
+        with self.dialing_lock:
+            if peer.peer_id in self.dialing or peer.peer_id in self.incompatible_ids:
+                if initial:
+                    self._phase_result(False)
+                return
+            token = self.dialing[peer.peer_id] = object()
+        threading.Thread(
+            target=self._dial_loop, args=(peer, token, initial), daemon=True
+        ).start()
+
+    # The peer left the swarm, do not reconnect once the connection drops.
+    def retire(self, peer_id):
+        with self.dialing_lock:
+            self.dialing.pop(peer_id, None)
+
+    def dialed_peer_ids(self):
+        with self.dialing_lock:
+            return set(self.dialing)
+
+    # token tells a retired dial loop apart from a newer one for the same peer
+    def _dial_loop(self, peer, token, initial):
+        try:
+            while not self.shutdown_event.is_set():
+                conn_socket = self._connect_with_retries(peer)
+                if initial:
+                    self._phase_result(conn_socket is not None)
+                    initial = False
+                if conn_socket is None:
+                    return
+                handler = self.start_handler(conn_socket, peer)
+                handler.join()
+                if getattr(handler, "incompatible", False):
+                    print(f"[{self.my_peer_id}] Not redialing {peer.peer_id}.")
+                    with self.dialing_lock:
+                        self.incompatible_ids.add(peer.peer_id)
+                    return
+                if (
+                    self.shutdown_event.is_set()
+                    or self.dialing.get(peer.peer_id) is not token
+                ):
+                    return
+                print(f"[{self.my_peer_id}] Lost {peer.peer_id}, reconnecting...")
+        finally:
+            with self.dialing_lock:
+                if self.dialing.get(peer.peer_id) is token:
+                    del self.dialing[peer.peer_id]
+
+    # Returns a connected socket, or None after max_retries failures.
+    def _connect_with_retries(self, peer):
+        host = "127.0.0.1" if self.local_testing else peer.ip_address
+        start = time.monotonic()
+        attempt = 0
+        while not self.shutdown_event.is_set():
+            attempt += 1
+            try:
+                with self.connect_slots:
+                    print(
+                        f"[{self.my_peer_id}] Connecting to {peer.peer_id} (attempt {attempt})..."
+                    )
+                    conn_socket = socket.create_connection(
+                        (host, peer.port), timeout=self.connect_timeout
+                    )
+                log_connect_result(
+                    self.my_peer_id,
+                    peer.peer_id,
+                    True,
+                    attempt,
+                    time.monotonic() - start,
+                )
+                return conn_socket
+            except OSError as e:
+                print(f"[{self.my_peer_id}] Failed to connect to {peer.peer_id}: {e}")
+
+            if attempt >= self.max_retries:
+                break
+            delay = min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1))
+            self.shutdown_event.wait(delay * random.uniform(0.5, 1.0))
+
+        log_connect_result(
+            self.my_peer_id, peer.peer_id, False, attempt, time.monotonic() - start
+        )
+        return None
+
+    def _phase_result(self, connected):
+        with self.phase_lock:
+            self.phase_pending -= 1
+            if connected:
+                self.phase_connected += 1
+            if self.phase_pending == 0:
+                log_connect_phase_done(
+                    self.my_peer_id,
+                    self.phase_connected,
+                    self.phase_total,
+                    time.monotonic() - self.phase_start,
+                )
@@ -0,0 +1,126 @@
+import os
+import queue
+import threading
+
+from config import FSYNC_POLICIES
+
+
+# Write-behind stage for downloaded pieces.
+#
+# Connection threads hand pieces to the DiskWriter and go straight back to
+# the network. A single disk thread drains the queue, sorts what it got by
+# offset, merges adjacent pieces into one pwritev call and fsyncs according
+# to the configured policy. Only after that the completion callback runs,
+# so callers can mark the bitfield / send HAVE once the data is durable.
+#
+# fsync policies:
+# - "always": fsync after every coalesced write.
+# - "batch":  one fsync per drained batch (default).
+# - "none":   never fsync, data is "durable" once the OS has it.
+class DiskWriter(threading.Thread):
+
+    FSYNC_POLICIES = FSYNC_POLICIES
+    MAX_BATCH = 64  # keeps us well below IOV_MAX
+
+    def __init__(self, file_path, on_written, fsync_policy="batch"):
+        super().__init__(daemon=True)
+        if fsync_policy not in self.FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy: {fsync_policy}")
+        self.file_path = file_path
+        self.on_written = on_written  # called as on_written(token, success)
+        self.fsync_policy = fsync_policy
+        self.queue = queue.Queue()
+        self.fd = os.open(file_path, os.O_WRONLY | getattr(os, "O_BINARY", 0))
+
+    def submit(self, offset, data, token):
+        self.queue.put((offset, data, token))
+
+    # No more pieces will come, the thread exits once the queue is flushed.
+    # Safe to call from the disk thread itself, close() still releases the fd.
+    def stop(self):
+        self.queue.put(None)
+
+    def close(self):
+        # None is the sentinel, everything queued before it is flushed.
+        self.queue.put(None)
+        self.join()
+        os.close(self.fd)
+
+    def run(self):
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            while len(batch) < self.MAX_BATCH:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if None in batch:
+                running = False
+                batch = [item for item in batch if item is not None]
+            if not batch:
+                continue
+
+            batch.sort(key=lambda item: item[0])
+            results = []
+            for run in self._coalesce(batch):
+                success = self._write_run(run)
+                results.extend((token, success) for _, _, token in run)
+            if self.fsync_policy == "batch":
+                success = self._fsync()
+                results = [(token, ok and success) for token, ok in results]
+
+            for token, success in results:
+                try:
+                    self.on_written(token, success)
+                except Exception as e:
+                    print(f"[DiskWriter] Error in completion callback: {e}")
+
+    # Groups sorted (offset, data, token) items into runs of contiguous bytes.
+    @staticmethod
+    def _coalesce(batch):
+        runs = []
+        for item in batch:
+            offset, data, _ = item
+            if runs:
+                last_offset, last_data, _ = runs[-1][-1]
+                if last_offset + len(last_data) == offset:
+                    runs[-1].append(item)
+                    continue
+            runs.append([item])
+        return runs
+
+    def _write_run(self, run):
+        offset = run[0][0]
+        buffers = [memoryview(data) for _, data, _ in run]
+        try:
+            if hasattr(os, "pwritev"):
+                # pwritev may write less than asked, keep going until done.
+                while buffers:
+                    written = os.pwritev(self.fd, buffers, offset)
+                    offset += written
+                    while buffers and written >= len(buffers[0]):
+                        written -= len(buffers[0])
+                        buffers.pop(0)
+                    if buffers and written:
+                        buffers[0] = buffers[0][written:]
+            else:  # Windows has no pwritev, fall back to one joined write
+                data = b"".join(buffers)
+                os.lseek(self.fd, offset, os.SEEK_SET)
+                while data:
+                    data = data[os.write(self.fd, data) :]
+            if self.fsync_policy == "always":
+                os.fsync(self.fd)
+            return True
+        except OSError as e:
+            print(f"[DiskWriter] ERROR writing {len(run)} piece(s) at {run[0][0]}: {e}")
+            return False
+
+    def _fsync(self):
+        try:
+            os.fsync(self.fd)
+            return True
+        except OSError as e:
+            print(f"[DiskWriter] ERROR during fsync: {e}")
+            return False
@@ -1,13 +1,35 @@
 import os
 import math
+import mmap
+from array import array
 from bitfield import Bitfield
+from config import PIECE_SELECTIONS, PREALLOCATIONS
+from disk_writer import DiskWriter
+from piece_reader import PieceReader
 import threading
 
 
 # This class is a helper to manage files being downloaded/shared.
 # It manages the bitfield and the file pieces on disj.
+#
+# With shared (a sharding.SharedState) the bitfield, the pending pieces, the
+# piece counter and the lock live in shared memory so several processes can
+# write pieces to the same file. Only the owner of the shared state creates
+# the file, the others just attach to it.
+#
+# Once every piece is on disk the FileManager is seed-only (self.seeding):
+# the disk thread is stopped and pieces are read from a read-only mmap of the
+# file, see enter_seed_mode. A peer that starts with the file never starts
+# the disk thread.
 class FileManager:
-    def __init__(self, my_peer_info, common_config):
+
+    PIECE_SELECTIONS = PIECE_SELECTIONS
+    # sparse: set the size only, blocks are allocated as pieces are written
+    # full:   reserve all blocks up front (posix_fallocate)
+    # none:   empty file, it grows as pieces are written
+    PREALLOCATIONS = PREALLOCATIONS
+
+    def __init__(self, my_peer_info, common_config, shared=None):
         self.peer_id = my_peer_info.peer_id
         self.file_name = common_config["FileName"]
         self.file_size = int(common_config["FileSize"])
@@ -16,6 +38,16 @@ class FileManager:
         # this is determined by config
         self.num_pieces = math.ceil(self.file_size / self.piece_size)
 
+        # random (spec) or sequential for consumers reading while we download
+        self.piece_selection = common_config.get("PieceSelection", "random")
+        if self.piece_selection not in self.PIECE_SELECTIONS:
+            raise ValueError(f"Unknown piece selection: {self.piece_selection}")
+        self.sequential_window = int(common_config.get("SequentialWindow", 4))
+
+        self.preallocation = common_config.get("Preallocation", "sparse")
+        if self.preallocation not in self.PREALLOCATIONS:
+            raise ValueError(f"Unknown preallocation mode: {self.preallocation}")
+
         # --- naming and creating the directory ---
 
         self.peer_dir = f"peer_{self.peer_id}"
@@ -24,57 +56,179 @@ class FileManager:
 
         os.makedirs(self.peer_dir, exist_ok=True)
 
-        # --- create bitfield for this peer's file ---
-        self.bitfield = Bitfield(self.num_pieces)
+        # --- create bitfield, piece count and lock for this peer's file ---
+        if shared is None:
+            self.bitfield = Bitfield(self.num_pieces)
+            self.have_count = array("I", [0])
+            self.file_lock = threading.Lock()  # To prevent race conditions
+            # pieces being written are tracked so duplicates are dropped early
+            self.pending_pieces = set()
+        else:
+            self.bitfield = Bitfield.over(self.num_pieces, shared.bitfield)
+            self.have_count = shared.have_count
+            self.file_lock = shared.lock
+            self.pending_pieces = shared.pending_pieces
+
+        self.seeding = False
+        self.seed_map = None
 
-        # --- NEW: Track piece count and file handle ---
-        self.num_pieces_have = 0
-        self.file_lock = threading.Lock()  # To prevent race conditions
+        # called as hook(piece_index) while file_lock is held, right after a
+        # piece is added to the bitfield (used for interest counting)
+        self.piece_added_hooks = []
 
-        if my_peer_info.has_file:
+        if shared is not None and not shared.owner:
+            pass  # the owner process already set up the file and bitfield
+        elif my_peer_info.has_file:
+            # seeding zeros would corrupt every peer, better not start at all
+            self._check_seed_file()
             print(f"[{self.peer_id}] Peer starts with the file.")
             self.bitfield.set_all()
             self.num_pieces_have = self.num_pieces
-            # Ensure the file exists for seeding
-            if not os.path.exists(self.file_path):
-                print(
-                    f"[{self.peer_id}] WARNING: Seed file not found at {self.file_path}. Creating empty file."
-                )
-                # Create an empty file of the correct size
-                with open(self.file_path, "wb") as f:
-                    f.seek(self.file_size - 1)
-                    f.write(b"\0")
         else:
             print(f"[{self.peer_id}] Peer starts with no pieces.")
-            # If we dont have the file, create an empty one to write into
-            # wb creates the file or truncates it if it exists.
-            with open(self.file_path, "wb") as f:
-                f.seek(self.file_size - 1)
-                f.write(b"\0")
+            self._create_file()
+
+        # --- write-behind disk stage, only needed while downloading ---
+        self.disk_writer = None
+        if self.is_complete():
+            self.enter_seed_mode()
+        else:
+            self.disk_writer = DiskWriter(
+                self.file_path,
+                self._on_piece_written,
+                common_config.get("FsyncPolicy", "batch"),
+            )
+            self.disk_writer.start()
 
         print(f"[{self.peer_id}] File Manager initialized.")
         print(f"[{self.peer_id}] My Bitfield: {self.bitfield}")
 
+    def _check_seed_file(self):
+        if not os.path.isfile(self.file_path):
+            raise FileNotFoundError(f"Seed file not found at {self.file_path}.")
+        size = os.path.getsize(self.file_path)
+        if size < self.file_size:
+            raise ValueError(
+                f"Seed file {self.file_path} has {size} bytes, FileSize is {self.file_size}."
+            )
+
+    # Creates (or truncates) the file to download into, see PREALLOCATIONS.
+    # No data is written here, so this takes the same time for any size.
+    def _create_file(self):
+        fd = os.open(
+            self.file_path,
+            os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0),
+        )
+        try:
+            if self.preallocation == "full":
+                try:
+                    os.posix_fallocate(fd, 0, self.file_size)
+                    return
+                except (AttributeError, OSError) as e:
+                    # not on Windows/macOS, nor on every file system
+                    print(
+                        f"[{self.peer_id}] WARNING: Could not preallocate ({e}), using a sparse file."
+                    )
+            if self.preallocation != "none":
+                os.ftruncate(fd, self.file_size)
+        finally:
+            os.close(fd)
+
+    # kept in a one element buffer so it can live in shared memory
+    @property
+    def num_pieces_have(self):
+        return self.have_count[0]
+
+    @num_pieces_have.setter
+    def num_pieces_have(self, value):
+        self.have_count[0] = value
+
+    # Picks the next piece to request from a peer, None if they have nothing
+    # we need (or it is all requested already).
+    def select_piece(self, their_bitfield, requested_pieces):
+        if self.piece_selection == "sequential":
+            return self.bitfield.select_sequential_piece(
+                their_bitfield, requested_pieces, self.sequential_window
+            )
+        return self.bitfield.select_random_piece(their_bitfield, requested_pieces)
+
+    # Returns a file-like PieceReader that yields the file in order as soon
+    # as the pieces are on disk. Close it when done.
+    def open_reader(self, timeout=None):
+        return PieceReader(self, timeout)
+
     def check_interest(self, their_bitfield):
         return self.bitfield.has_interesting_pieces(their_bitfield)
 
-    def write_piece(self, piece_index, data):  # writes data to correct piece in file
-        offset = piece_index * self.piece_size
+    # caller must hold file_lock for the count to stay exact
+    def count_interesting(self, their_bitfield):
+        return self.bitfield.count_interesting_pieces(their_bitfield)
 
+    # Queues a piece for the disk thread and returns right away.
+    # on_written(piece_index, success) is called from the disk thread once the
+    # piece is durable, the bitfield is only updated at that point.
+    # Returns False if the piece is already present or being written.
+    def write_piece(self, piece_index, data, on_written=None):
         with self.file_lock:
-            try:
-                # 'r+b' means read/write in binary mode
-                with open(self.file_path, "r+b") as f:
-                    f.seek(offset)
-                    f.write(data)
+            if (
+                self.bitfield.has_piece(piece_index)
+                or piece_index in self.pending_pieces
+            ):
+                return False
+            self.pending_pieces.add(piece_index)
+
+        offset = piece_index * self.piece_size
+        self.disk_writer.submit(offset, data, (piece_index, on_written))
+        return True
 
+    # DiskWriter completion callback, runs on the disk thread.
+    def _on_piece_written(self, token, success):
+        piece_index, on_written = token
+
+        with self.file_lock:
+            self.pending_pieces.discard(piece_index)
+            if success:
                 # remember to update state
                 self.bitfield.set_piece(piece_index)
                 self.num_pieces_have += 1
-                return True
-            except IOError as e:
-                print(f"[{self.peer_id}] ERROR writing piece {piece_index}: {e}")
-                return False
+                for hook in self.piece_added_hooks:
+                    hook(piece_index)
+            else:
+                print(f"[{self.peer_id}] ERROR writing piece {piece_index}")
+
+        if on_written is not None:
+            on_written(piece_index, success)
+
+        if success and self.is_complete():
+            self.enter_seed_mode()
+
+    # Switches to seed-only mode, called once the last piece is durable (or
+    # at startup with the complete file). Nothing is written any more, so the
+    # disk thread is told to exit and read_piece serves uploads from a
+    # read-only mmap without file_lock. Connections check self.seeding to skip
+    # interest and request handling.
+    def enter_seed_mode(self):
+        with self.file_lock:
+            if self.seeding:
+                return
+            try:
+                with open(self.file_path, "rb") as f:
+                    self.seed_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError) as e:
+                print(
+                    f"[{self.peer_id}] WARNING: Could not map {self.file_path} ({e}), reading pieces from the file."
+                )
+            self.seeding = True
+        if self.disk_writer is not None:
+            self.disk_writer.stop()
+        print(f"[{self.peer_id}] File complete, seed-only mode.")
+
+    # flushes outstanding writes, call before exiting
+    def close(self):
+        if self.disk_writer is not None:
+            self.disk_writer.close()
+        if self.seed_map is not None:
+            self.seed_map.close()
 
     # reads piece of file
     def read_piece(self, piece_index):
@@ -84,6 +238,9 @@ class FileManager:
         if piece_index == self.num_pieces - 1:  # note if last piece it might be smaller
             size = self.file_size - offset
 
+        if self.seed_map is not None:
+            return self.seed_map[offset : offset + size]
+
         with self.file_lock:
             try:
                 with open(self.file_path, "rb") as f:
@@ -93,7 +250,7 @@ class FileManager:
             except IOError as e:
                 print(f"[{self.peer_id}] ERROR reading piece {piece_index}: {e}")
                 return None
-    
+
     # convenicene method to check if complete
     def is_complete(self):
         return self.num_pieces_have == self.num_pieces
@@ -6,9 +6,10 @@ peer_logger = logging.getLogger("p2p")
 is_setup = False
 
 
-def setup_logging(peer_id):
+def setup_logging(peer_id, mode="w"):
     """
     Configures the logger to write to the correct file.
+    Worker processes (sharding) pass mode="a" to not truncate it.
     """
     global is_setup
     if is_setup:
@@ -16,7 +17,7 @@ def setup_logging(peer_id):
 
     log_file = f"log_peer_{peer_id}.log"
     peer_logger.setLevel(logging.INFO)
-    handler = logging.FileHandler(log_file, mode="w")
+    handler = logging.FileHandler(log_file, mode=mode)
     formatter = logging.Formatter(
         "%(asctime)s: %(message)s", datefmt="%Y-%m-%d %H:%M:%S"
     )
@@ -69,6 +70,14 @@ def log_receive_have(my_id, other_id, piece_index):
     )
 
 
+def log_receive_have_batch(my_id, other_id, piece_indices):
+    # Extension: one line for a whole HAVE_BATCH instead of one per piece.
+    pieces = ",".join(map(str, piece_indices))
+    peer_logger.info(
+        f"Peer {my_id} received the 'have' message from {other_id} for the pieces [{pieces}]."
+    )
+
+
 def log_receive_interested(my_id, other_id):
     # [Time]: Peer [peer_ID 1] received the 'interested' message from [peer_ID 2].
     peer_logger.info(f"Peer {my_id} received the 'interested' message from {other_id}.")
@@ -91,3 +100,26 @@ def log_download_piece(my_id, other_id, piece_index, num_pieces):
 def log_download_complete(my_id):
     # [Time]: Peer [peer_ID] has downloaded the complete file.
     peer_logger.info(f"Peer {my_id} has downloaded the complete file.")
+
+
+# --- Extra (not in the spec): connect phase timeline ---
+
+
+def log_connect_result(my_id, other_id, connected, attempts, elapsed):
+    result = "connected" if connected else "gave up"
+    peer_logger.info(
+        f"Peer {my_id} {result} to Peer {other_id} after {attempts} attempt(s) in {elapsed:.3f}s."
+    )
+
+
+def log_connect_phase_done(my_id, num_connected, num_peers, elapsed):
+    peer_logger.info(
+        f"Peer {my_id} finished the connect phase in {elapsed:.3f}s: {num_connected}/{num_peers} peers connected."
+    )
+
+
+def log_receive_pex(my_id, other_id, num_peers, new_peer_ids):
+    new_peers = ",".join(map(str, new_peer_ids))
+    peer_logger.info(
+        f"Peer {my_id} received {num_peers} peer address(es) from {other_id}, new: [{new_peers}]."
+    )
@@ -1,30 +1,62 @@
 # ref pag 1 protocol description
+import socket
 import struct
 
+# Precompiled structs, used for every message.
+# '!I' = 4-byte big-endian integer, '!B' = 1-byte unsigned char
+LENGTH_STRUCT = struct.Struct("!I")
+HEADER_STRUCT = struct.Struct("!IB")  # length + type
+INDEX_HEADER_STRUCT = struct.Struct("!IBI")  # length + type + piece index
+PEX_ENTRY_STRUCT = struct.Struct("!IHB")  # peer id + port + host length
+
+
+# Reads exactly num_bytes from the socket, raises IOError if the peer closes.
+def recv_exact(conn_socket, num_bytes, what="message"):
+    data = bytearray()
+    while len(data) < num_bytes:
+        chunk = conn_socket.recv(num_bytes - len(data))
+        if not chunk:
+            raise IOError(f"Connection closed unexpectedly while reading {what}.")
+        data += chunk
+    return bytes(data)
+
 
 # Class to manage creation and parsing of Handshake message.
 # - to_bytes: Converts interal representation into 32-byte handshake message.
 # - from_bytes: Parses 32-byte message and returns Handshake object OR raises if invalid.
 #
-#     ---------------------------------------------------------
-#    | P2PFILESHARINGPROJ | 10 empty bytes (\x00) | 4 byte pid |
-#     ---------------------------------------------------------
+#     ----------------------------------------------------------------------------------
+#    | P2PFILESHARINGPROJ | 4 empty bytes | 4 byte piece size | 2 byte extensions | 4 byte pid |
+#     ----------------------------------------------------------------------------------
 #
+# The piece size and extensions fields are carved out of the 10 zero bytes of
+# the spec, so a peer that does not know about them sends (and ignores) zeros.
+# An extension is only used when both sides set its bit. A piece size of 0
+# means unknown, otherwise both sides must use the same one.
 class Handshake:
 
+    __slots__ = ("peer_id", "extensions", "piece_size")
+
     HEADER = b"P2PFILESHARINGPROJ"
 
-    def __init__(self, peer_id):
+    # extension bits
+    EXT_HAVE_BATCH = 1 << 0
+    EXT_PEX = 1 << 1
+
+    def __init__(self, peer_id, extensions=0, piece_size=0):
         # could check if 4 byte pid
         self.peer_id = peer_id
+        self.extensions = extensions
+        self.piece_size = piece_size
 
     def to_bytes(self):
-        zero_bits = bytes(10)  # 10-byte zero bits
+        zero_bits = bytes(4)  # 4-byte zero bits
 
-        # NOTE: '!' means network (big-endian) byte order and 'I' means 4-byte unsigned integer.
-        peer_id_bytes = struct.pack("!I", self.peer_id)
+        # NOTE: '!' means network (big-endian) byte order, 'H' means 2-byte and
+        # 'I' means 4-byte unsigned integer.
+        tail_bytes = struct.pack("!IHI", self.piece_size, self.extensions, self.peer_id)
 
-        return self.HEADER + zero_bits + peer_id_bytes
+        return self.HEADER + zero_bits + tail_bytes
 
     @staticmethod
     def from_bytes(message_bytes):
@@ -34,14 +66,18 @@ class Handshake:
         # Help of GPT:
         # Unpack the header and peer ID
         # '18s' = 18-byte string
-        # '10x' = 10 "padding" bytes (we ignore them)
+        # '4x'  = 4 "padding" bytes (we ignore them)
+        # 'I'   = 4-byte piece size
+        # 'H'   = 2-byte extension bits
         # '!I'  = 4-byte big-endian unsigned integer
-        header, peer_id = struct.unpack("!18s10xI", message_bytes)
+        header, piece_size, extensions, peer_id = struct.unpack(
+            "!18s4xIHI", message_bytes
+        )
 
         if header != Handshake.HEADER:
             raise ValueError(f"Invalid handshake header. Got: {header}")
 
-        return Handshake(peer_id)
+        return Handshake(peer_id, extensions, piece_size)
 
 
 # Represnets the actual message after the initial handshake.
@@ -60,82 +96,139 @@ class Message:
     BITFIELD = 5
     REQUEST = 6
     PIECE = 7
+    # extension (Handshake.EXT_HAVE_BATCH), payload is a list of 4-byte indices
+    HAVE_BATCH = 8
+    # extension (Handshake.EXT_PEX), payload is a list of peer addresses
+    PEX = 9
+
+    # Zero length message (no type byte), only used to keep the connection alive.
+    KEEP_ALIVE = -1
+    KEEP_ALIVE_BYTES = bytes(4)
+
+    # Messages without payload never change, so they are encoded once.
+    CHOKE_FRAME = HEADER_STRUCT.pack(1, CHOKE)
+    UNCHOKE_FRAME = HEADER_STRUCT.pack(1, UNCHOKE)
+    INTERESTED_FRAME = HEADER_STRUCT.pack(1, INTERESTED)
+    NOT_INTERESTED_FRAME = HEADER_STRUCT.pack(1, NOT_INTERESTED)
+
+    TYPE_NAMES = (
+        "CHOKE",
+        "UNCHOKE",
+        "INTERESTED",
+        "NOT_INTERESTED",
+        "HAVE",
+        "BITFIELD",
+        "REQUEST",
+        "PIECE",
+        "HAVE_BATCH",
+        "PEX",
+    )
+
+    __slots__ = ("msg_type", "payload", "msg_length")
 
     def __init__(self, msg_type, payload=b""):
         self.msg_type = msg_type
         self.payload = payload
 
         # Length is 1 byte for type + length of payload
-        self.msg_length = 1 + len(payload)
+        self.msg_length = 0 if msg_type == Message.KEEP_ALIVE else 1 + len(payload)
 
     def to_bytes(self):
-        # Again, at the suggestion of GPT
-        # '!I' = 4-byte big-endian integer (for length)
-        # '!B' = 1-byte unsigned char (for type)
-        return struct.pack("!IB", self.msg_length, self.msg_type) + self.payload
+        if self.msg_type == Message.KEEP_ALIVE:
+            return Message.KEEP_ALIVE_BYTES
+        return HEADER_STRUCT.pack(self.msg_length, self.msg_type) + self.payload
 
     @staticmethod
     def create_bitfield_message(bitfield):
         return Message(Message.BITFIELD, bitfield.to_bytes())
 
+    @staticmethod
+    def create_keepalive_message():
+        return Message(Message.KEEP_ALIVE)
+
+    # The payload-less factories hand out shared instances (see below the class).
     @staticmethod
     def create_choke_message():
-        return Message(Message.CHOKE)
+        return _CHOKE_MESSAGE
 
     @staticmethod
     def create_unchoke_message():
-        return Message(Message.UNCHOKE)
+        return _UNCHOKE_MESSAGE
 
     @staticmethod
     def create_interested_message():
-        return Message(Message.INTERESTED)
+        return _INTERESTED_MESSAGE
 
     @staticmethod
     def create_not_interested_message():
-        return Message(Message.NOT_INTERESTED)
+        return _NOT_INTERESTED_MESSAGE
 
     @staticmethod
     def create_have_message(piece_index):
         # Payload is a 4-byte piece index
-        payload = struct.pack("!I", piece_index)
+        payload = LENGTH_STRUCT.pack(piece_index)
         return Message(Message.HAVE, payload)
 
     @staticmethod
-    def create_bitfield_message(bitfield):
-        return Message(Message.BITFIELD, bitfield.to_bytes())
+    def create_have_batch_message(piece_indices):
+        payload = struct.pack(f"!{len(piece_indices)}I", *piece_indices)
+        return Message(Message.HAVE_BATCH, payload)
+
+    # peers is a list of (peer_id, host, port). An empty host means "the
+    # address you see me at", used for the sender's own entry.
+    @staticmethod
+    def create_pex_message(peers):
+        payload = bytearray()
+        for peer_id, host, port in peers:
+            host_bytes = host.encode()
+            payload += PEX_ENTRY_STRUCT.pack(peer_id, port, len(host_bytes))
+            payload += host_bytes
+        return Message(Message.PEX, bytes(payload))
 
     @staticmethod
     def create_request_message(piece_index):
         # Payload is a 4-byte piece index
-        payload = struct.pack("!I", piece_index)
+        payload = LENGTH_STRUCT.pack(piece_index)
         return Message(Message.REQUEST, payload)
 
     @staticmethod
     def create_piece_message(piece_index, content):
         # Payload is 4-byte index + content
-        payload_header = struct.pack("!I", piece_index)
+        payload_header = LENGTH_STRUCT.pack(piece_index)
         return Message(Message.PIECE, payload_header + content)
 
-    # --- (read_from_socket and __str__ are unchanged) ---
+    # Encoders for the hot path, go straight to bytes without a Message object.
+    @staticmethod
+    def encode_have(piece_index):
+        return INDEX_HEADER_STRUCT.pack(5, Message.HAVE, piece_index)
+
+    @staticmethod
+    def encode_request(piece_index):
+        return INDEX_HEADER_STRUCT.pack(5, Message.REQUEST, piece_index)
+
+    @staticmethod
+    def encode_piece(piece_index, content):
+        header = INDEX_HEADER_STRUCT.pack(5 + len(content), Message.PIECE, piece_index)
+        return header + content
+
+    # Once a message has started it has to be read completely, a timeout in
+    # the middle means the stream can not be resynced, so it is raised as IOError.
     @staticmethod
     def read_from_socket(conn_socket):
         header_len_bytes = conn_socket.recv(4)
         if not header_len_bytes:
             return None
-        if len(header_len_bytes) < 4:
-            raise IOError(
-                "Connection closed unexpectedly while reading message length."
-            )
-        msg_length = struct.unpack("!I", header_len_bytes)[0]
-        message_body_bytes = b""
-        bytes_to_read = msg_length
-        while len(message_body_bytes) < bytes_to_read:
-            chunk = conn_socket.recv(bytes_to_read - len(message_body_bytes))
-            if not chunk:
-                raise IOError(
-                    "Connection closed unexpectedly while reading message body."
+        try:
+            if len(header_len_bytes) < 4:
+                header_len_bytes += recv_exact(
+                    conn_socket, 4 - len(header_len_bytes), "message length"
                 )
-            message_body_bytes += chunk
+            msg_length = LENGTH_STRUCT.unpack(header_len_bytes)[0]
+            if msg_length == 0:
+                return Message(Message.KEEP_ALIVE)
+            message_body_bytes = recv_exact(conn_socket, msg_length, "message body")
+        except socket.timeout:
+            raise IOError("Timed out in the middle of a message.")
         msg_type = message_body_bytes[0]
         payload = message_body_bytes[1:]
         return Message(msg_type, payload)
@@ -143,30 +236,57 @@ class Message:
     # New payload parsers
     def parse_have_payload(self):
         # Payload is 4-byte piece index
-        return struct.unpack("!I", self.payload)[0]
+        return LENGTH_STRUCT.unpack(self.payload)[0]
+
+    def parse_have_batch_payload(self):
+        # Payload is n 4-byte piece indices
+        if len(self.payload) % 4 != 0:
+            raise ValueError("HAVE_BATCH payload is not a multiple of 4 bytes.")
+        return list(struct.unpack(f"!{len(self.payload) // 4}I", self.payload))
+
+    def parse_pex_payload(self):
+        # Payload is n entries of 4-byte peer id, 2-byte port, 1-byte host
+        # length and the host
+        peers = []
+        offset = 0
+        while offset < len(self.payload):
+            if offset + PEX_ENTRY_STRUCT.size > len(self.payload):
+                raise ValueError("Truncated PEX entry.")
+            peer_id, port, host_length = PEX_ENTRY_STRUCT.unpack_from(
+                self.payload, offset
+            )
+            offset += PEX_ENTRY_STRUCT.size
+            if offset + host_length > len(self.payload):
+                raise ValueError("Truncated PEX host.")
+            host = self.payload[offset : offset + host_length].decode()
+            offset += host_length
+            peers.append((peer_id, host, port))
+        return peers
 
     def parse_request_payload(self):
         # Payload is 4-byte piece index
-        return struct.unpack("!I", self.payload)[0]
+        return LENGTH_STRUCT.unpack(self.payload)[0]
 
     def parse_piece_payload(self):
         # Payload is 4-byte index + content
-        piece_index = struct.unpack("!I", self.payload[:4])[0]
+        piece_index = LENGTH_STRUCT.unpack_from(self.payload)[0]
         content = self.payload[4:]
         return piece_index, content
 
+    def type_name(self):
+        if self.msg_type == Message.KEEP_ALIVE:
+            return "KEEP_ALIVE"
+        if self.msg_type > len(Message.TYPE_NAMES) - 1:
+            return f"UNKNOWN({self.msg_type})"
+        return Message.TYPE_NAMES[self.msg_type]
+
     def __str__(self):
         # A helper for debugging
-        type_names = [
-            "CHOKE",
-            "UNCHOKE",
-            "INTERESTED",
-            "NOT_INTERESTED",
-            "HAVE",
-            "BITFIELD",
-            "REQUEST",
-            "PIECE",
-        ]
-        if self.msg_type > len(type_names) - 1:
-            return f"[Msg: UNKNOWN({self.msg_type}), Len: {self.msg_length}]"
-        return f"[Msg: {type_names[self.msg_type]}, Len: {self.msg_length}]"
+        return f"[Msg: {self.type_name()}, Len: {self.msg_length}]"
+
+
+# shared instances returned by the factories, never mutated
+_CHOKE_MESSAGE = Message(Message.CHOKE)
+_UNCHOKE_MESSAGE = Message(Message.UNCHOKE)
+_INTERESTED_MESSAGE = Message(Message.INTERESTED)
+_NOT_INTERESTED_MESSAGE = Message(Message.NOT_INTERESTED)
@@ -1,4 +1,6 @@
 class Peer:  # could rewrite as @dataclass
+    __slots__ = ("peer_id", "ip_address", "port", "has_file", "bitfield")
+
     def __init__(self, peer_id, ip_address, port, has_file):
         self.peer_id = int(peer_id)
         self.ip_address = ip_address
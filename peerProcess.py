@@ -1,25 +1,36 @@
 import sys
-import re
+import argparse
+import math
+import multiprocessing
 import socket
 import threading
 import time
 import struct
 import queue
+import random
+import select
+import signal
 
 from peer import Peer
+from config import ConfigError, read_common_config, read_peer_info, resolve_piece_size
 from logger import *
-from message import Handshake, Message
+from message import Handshake, Message, recv_exact
 from file_manager import FileManager
 from bitfield import Bitfield
 from peer_manager import PeerManager
-
+from connector import PeerConnector
+from sharding import SharedState, ShardPeerManager, ShardCoordinator
+from rate_limiter import TokenBucket, consume_together
+from tracker_client import TrackerClient
+from disk_writer import DiskWriter
+from profiler import profiler
 
 # --- CHANGE PARAMS ---
-# - LOCAL_TESTING is a flag that indicates if we are testing locally. If so it disregards IP's from PEER_INFO_FILE
-#       and uses the loopback address
+# - LOCAL_TESTING is a flag that indicates if we are testing locally. If so it disregards IP's from the peer info file
+#       and uses the loopback address. It is only the default, --local / --remote override it.
 #
 # Also, you can set LOCAL_TESTING_PEER_FILE and LOCAL_TESTING_PEER_INFO_FILE, which will be used depending
-# on the LOCAL_TESTING flag.
+# on the LOCAL_TESTING flag, unless --common / --peer-info are given.
 
 LOCAL_TESTING = True
 
@@ -29,43 +40,80 @@ LOCAL_TESTING_PEER_INFO_FILE = "HelloWorldPeerInfo.cfg"
 PROD_PEER_FILE = "Common.cfg"
 PROD_PEER_INFO_FILE = "PeerInfo.cfg"
 
-# --- DO NOT CHANGE ---
-COMMON_PEER_FILE = LOCAL_TESTING_PEER_FILE if LOCAL_TESTING else PROD_PEER_FILE
-PEER_INFO_FILE = LOCAL_TESTING_PEER_INFO_FILE if LOCAL_TESTING else PROD_PEER_INFO_FILE
-
-
-def read_common_config():
-    try:
-        config = open(COMMON_PEER_FILE, "r")
-        config_dict = {}
-        for line in config:
-            match = re.findall(r"(\S+)", line)
-            if match:
-                config_dict[match[0]] = match[1]
-        config.close()
-        return config_dict
-    except FileNotFoundError:
-        print(f"FATAL ERROR: {COMMON_PEER_FILE} not found.")
-        sys.exit(1)
+# extensions we announce in the handshake (PEX only when it is enabled)
+MY_EXTENSIONS = Handshake.EXT_HAVE_BATCH | Handshake.EXT_PEX
+
+# pieces are paid for and sent in slices of this size, see _send_paced
+PACE_SLICE = 65536
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Peer of the P2P file sharing swarm.")
+    parser.add_argument("peer_id", type=int)
+    # only used with a tracker, for peers that are not in the peer info file
+    parser.add_argument("port", type=int, nargs="?")
+    parser.add_argument("has_file", type=int, nargs="?", default=0, choices=(0, 1))
+    parser.add_argument("--common", help="common config file")
+    parser.add_argument("--peer-info", help="peer info file")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        "--local",
+        dest="local_testing",
+        action="store_true",
+        default=LOCAL_TESTING,
+        help="connect to every peer on 127.0.0.1",
+    )
+    mode.add_argument(
+        "--remote",
+        dest="local_testing",
+        action="store_false",
+        help="connect to the hosts from the peer info file",
+    )
+    parser.add_argument(
+        "--check", action="store_true", help="validate the config files and exit"
+    )
+    args = parser.parse_args()
+    if args.common is None:
+        args.common = LOCAL_TESTING_PEER_FILE if args.local_testing else PROD_PEER_FILE
+    if args.peer_info is None:
+        args.peer_info = (
+            LOCAL_TESTING_PEER_INFO_FILE if args.local_testing else PROD_PEER_INFO_FILE
+        )
+    return args
 
 
-def read_peer_info_config():
-    try:
-        config = open(PEER_INFO_FILE, "r")
-        peer_list = []
-        for line in config:
-            match = re.findall(r"(\S+)", line)
-            if match:
-                current_peer = Peer(match[0], match[1], match[2], match[3])
-                peer_list.append(current_peer)
-        config.close()
-        return peer_list
-    except FileNotFoundError:
-        print(f"FATAL ERROR: {PEER_INFO_FILE} not found.")
-        sys.exit(1)
+class ConnectionHandler(threading.Thread):
 
+    # Thread itself keeps a __dict__, but our own attributes go in slots.
+    __slots__ = (
+        "conn_socket",
+        "my_peer_id",
+        "peer_manager",
+        "file_manager",
+        "expected_peer_id",
+        "other_peer_id",
+        "their_bitfield",
+        "slot",
+        "am_interested_in_them",
+        "num_interesting",
+        "interest_lock",
+        "interest_changed",
+        "they_are_choking_me",
+        "start_time",
+        "upload_start_time",
+        "requested_pieces",
+        "extensions",
+        "suppressed_haves",
+        "last_sent",
+        "last_received",
+        "send_lock",
+        "piece_in_flight",
+        "deferred_sends",
+        "upload_bucket",
+        "download_bucket",
+        "incompatible",
+    )
 
-class ConnectionHandler(threading.Thread):
     def __init__(
         self, conn_socket, my_peer_id, peer_manager, file_manager, expected_peer_id=None
     ):
@@ -77,13 +125,74 @@ class ConnectionHandler(threading.Thread):
         self.expected_peer_id = expected_peer_id
         self.other_peer_id = None
         self.their_bitfield = Bitfield(file_manager.num_pieces)
-        self.am_choking_them = True
+        self.slot = None  # our row in peer_manager.table, set on registration
         self.am_interested_in_them = False
+        # pieces they have that we lack, kept up to date under
+        # file_manager.file_lock (their HAVEs here, our pieces in PeerManager)
+        self.num_interesting = 0
+        self.interest_lock = threading.Lock()
+        # set by the disk thread when we got a piece, our own thread then
+        # re-checks interest (see PeerManager.update_interest)
+        self.interest_changed = False
         self.they_are_choking_me = True
-        self.is_interested_in_me = False
         self.start_time = time.time()
-        self.bytes_downloaded = 0
-        self.requested_pieces = set()
+        self.upload_start_time = time.time()
+        # piece index -> time.monotonic() when it was requested
+        self.requested_pieces = {}
+
+        # extensions both sides agreed on in the handshake
+        self.extensions = 0
+        # our HAVEs they did not need (they own the piece), sent on completion
+        self.suppressed_haves = []
+
+        # for keepalive / idle detection
+        self.last_sent = time.monotonic()
+        self.last_received = time.monotonic()
+
+        # one writer at a time. Pieces go out slice by slice and must not be
+        # cut by messages from timer/disk threads, those are queued in
+        # deferred_sends while piece_in_flight and sent after the piece.
+        self.send_lock = threading.Lock()
+        self.piece_in_flight = False
+        self.deferred_sends = []
+        self.upload_bucket = TokenBucket(peer_manager.per_peer_upload_rate)
+        self.download_bucket = TokenBucket(peer_manager.per_peer_download_rate)
+        # set when the peer can never work with us (e.g. other piece size),
+        # PeerConnector does not redial it then
+        self.incompatible = False
+
+    # choke/interest flags and byte counter live in the PeerManager table
+    @property
+    def am_choking_them(self):
+        return self.peer_manager.table.am_choking[self.slot] == 1
+
+    @am_choking_them.setter
+    def am_choking_them(self, value):
+        self.peer_manager.table.am_choking[self.slot] = int(value)
+
+    @property
+    def is_interested_in_me(self):
+        return self.peer_manager.table.interested_in_me[self.slot] == 1
+
+    @is_interested_in_me.setter
+    def is_interested_in_me(self, value):
+        self.peer_manager.table.interested_in_me[self.slot] = int(value)
+
+    @property
+    def bytes_downloaded(self):
+        return self.peer_manager.table.bytes_downloaded[self.slot]
+
+    @bytes_downloaded.setter
+    def bytes_downloaded(self, value):
+        self.peer_manager.table.bytes_downloaded[self.slot] = value
+
+    @property
+    def bytes_uploaded(self):
+        return self.peer_manager.table.bytes_uploaded[self.slot]
+
+    @bytes_uploaded.setter
+    def bytes_uploaded(self, value):
+        self.peer_manager.table.bytes_uploaded[self.slot] = value
 
     def get_download_rate(self):
         duration = time.time() - self.start_time
@@ -94,16 +203,40 @@ class ConnectionHandler(threading.Thread):
         self.start_time = time.time()
         return rate
 
+    # used to rank peers when we are seeding (SeedChoking upload)
+    def get_upload_rate(self):
+        duration = time.time() - self.upload_start_time
+        if duration == 0:
+            return 0
+        rate = self.bytes_uploaded / duration
+        self.bytes_uploaded = 0
+        self.upload_start_time = time.time()
+        return rate
+
     def run(self):
+        idle_timeout = self.peer_manager.idle_timeout
         try:
+            # a half-open connection should not hang reads or sends forever
+            self.conn_socket.settimeout(idle_timeout)
+
             # handshake
-            my_handshake = Handshake(self.my_peer_id)
-            self.conn_socket.sendall(my_handshake.to_bytes())
-            received_bytes = self.conn_socket.recv(32)
-            if not received_bytes:
-                raise Exception("Connection closed before handshake.")
+            my_extensions = MY_EXTENSIONS
+            if self.peer_manager.pex is None:
+                my_extensions &= ~Handshake.EXT_PEX
+            my_handshake = Handshake(
+                self.my_peer_id, my_extensions, self.file_manager.piece_size
+            )
+            self._send(my_handshake.to_bytes())
+            received_bytes = recv_exact(self.conn_socket, 32, "handshake")
             received_handshake = Handshake.from_bytes(received_bytes)
             self.other_peer_id = received_handshake.peer_id
+            self.extensions = my_extensions & received_handshake.extensions
+            if received_handshake.piece_size not in (0, self.file_manager.piece_size):
+                self.incompatible = True
+                raise Exception(
+                    f"Peer {self.other_peer_id} uses piece size {received_handshake.piece_size}, "
+                    f"we use {self.file_manager.piece_size}. Check PieceSize / FileSize."
+                )
             if (
                 self.expected_peer_id is not None
                 and self.other_peer_id != self.expected_peer_id
@@ -124,44 +257,59 @@ class ConnectionHandler(threading.Thread):
             else:
                 log_tcp_connection_from(self.my_peer_id, self.other_peer_id)
 
-            # exchange bitfield
-            bitfield_msg = Message.create_bitfield_message(self.file_manager.bitfield)
-            self.conn_socket.sendall(bitfield_msg.to_bytes())
+            # exchange bitfield, a super-seeder starts out with an empty one
+            super_seeder = self.peer_manager.super_seeder
+            sent_empty = super_seeder is not None and super_seeder.active
+            if sent_empty:
+                my_bitfield = Bitfield(self.file_manager.num_pieces)
+            else:
+                my_bitfield = self.file_manager.bitfield
+            bitfield_msg = Message.create_bitfield_message(my_bitfield)
+            self._send(bitfield_msg.to_bytes())
             bitfield_msg = Message.read_from_socket(self.conn_socket)
             if bitfield_msg is None or bitfield_msg.msg_type != Message.BITFIELD:
                 raise Exception("Did not receive bitfield after handshake.")
-            self.their_bitfield = Bitfield.from_bytes(
+            their_bitfield = Bitfield.from_bytes(
                 self.file_manager.num_pieces, bitfield_msg.payload
             )
+            # the only full scan, afterwards the count is kept incrementally
+            # (a seeder has nothing to count, num_interesting stays 0)
+            with self.file_manager.file_lock:
+                self.their_bitfield = their_bitfield
+                if not self.file_manager.seeding:
+                    self.num_interesting = self.file_manager.count_interesting(
+                        their_bitfield
+                    )
             print(f"[{self.my_peer_id}] Received bitfield from {self.other_peer_id}.")
 
             # notify manager of bitfield
             self.peer_manager.update_peer_bitfield(
                 self.other_peer_id, self.their_bitfield
             )
+            if super_seeder is not None:
+                super_seeder.add_peer(self, sent_empty)
 
             # send interested
-            if self.file_manager.check_interest(self.their_bitfield):
-                self.am_interested_in_them = True
-                self.conn_socket.sendall(Message.create_interested_message().to_bytes())
-            else:
-                self.am_interested_in_them = False
-                self.conn_socket.sendall(
-                    Message.create_not_interested_message().to_bytes()
-                )
+            with self.interest_lock:
+                if self.num_interesting > 0:
+                    self.am_interested_in_them = True
+                    self._send(Message.INTERESTED_FRAME)
+                else:
+                    self.am_interested_in_them = False
+                    self._send(Message.NOT_INTERESTED_FRAME)
 
             # --- MAIN LOOP ---
             while not self.peer_manager.shutdown_event.is_set():
-
-                self.conn_socket.settimeout(
-                    1.0
-                )  # timeout so it does not block for ever
-                try:
-                    msg = Message.read_from_socket(self.conn_socket)
-                except socket.timeout:
+                self.check_deadlines()
+                if self.interest_changed:
+                    self.interest_changed = False
+                    self.update_interest()
+
+                # wait at most 1s for data so shutdown and deadlines get checked
+                readable, _, _ = select.select([self.conn_socket], [], [], 1.0)
+                if not readable:
                     continue
-
-                self.conn_socket.settimeout(None)  # reseting timeout
+                msg = Message.read_from_socket(self.conn_socket)
 
                 if msg is None:
                     print(
@@ -169,6 +317,11 @@ class ConnectionHandler(threading.Thread):
                     )
                     break
 
+                self.last_received = time.monotonic()
+
+                if msg.msg_type == Message.PIECE:
+                    self._throttle_download(msg.msg_length + 4)
+
                 self.handle_message(msg)
 
         except (IOError, socket.error) as e:
@@ -179,13 +332,51 @@ class ConnectionHandler(threading.Thread):
             )
         finally:
             self.conn_socket.close()
-            self.peer_manager.remove_connection(self.other_peer_id)
+            self.peer_manager.remove_connection(self.other_peer_id, self)
+            if self.peer_manager.super_seeder is not None:
+                self.peer_manager.super_seeder.remove_peer(self.other_peer_id)
+            if self.peer_manager.pex is not None:
+                self.peer_manager.pex.remove_peer(self.other_peer_id)
             print(f"[{self.my_peer_id}] Connection with {self.other_peer_id} closed.")
 
+    # Called from the main loop about once a second. Sends a keepalive when
+    # we have been quiet, and raises IOError (dropping the connection) when the
+    # peer went silent or sits on one of our requests for too long.
+    def check_deadlines(self):
+        now = time.monotonic()
+        # data already waiting means we were busy (sending a big piece), not them
+        if now - self.last_received > self.peer_manager.idle_timeout and not (
+            select.select([self.conn_socket], [], [], 0)[0]
+        ):
+            raise IOError(
+                f"No message from {self.other_peer_id} in {self.peer_manager.idle_timeout}s."
+            )
+        if self.file_manager.seeding and self.requested_pieces:
+            # requests still out when we completed (pieces another peer sent
+            # first) will never matter, no reason to wait for them
+            self.requested_pieces.clear()
+        for piece_index, requested_at in list(self.requested_pieces.items()):
+            if piece_index in self.file_manager.pending_pieces:
+                continue  # already received, waiting on the disk thread
+            if now - requested_at > self.peer_manager.request_timeout:
+                # dropping the connection hands the piece back to the others
+                raise IOError(
+                    f"Request for piece {piece_index} timed out after {self.peer_manager.request_timeout:.0f}s."
+                )
+        if now - self.last_sent > self.peer_manager.keepalive_interval:
+            self.send_keepalive()
+
     def handle_message(self, msg):
-        if msg.msg_type == Message.CHOKE:
+        if msg.msg_type == Message.KEEP_ALIVE:
+            pass  # last_received is already updated
+        elif msg.msg_type == Message.CHOKE:
             log_choking(self.my_peer_id, self.other_peer_id)
             self.they_are_choking_me = True
+            # a choking peer drops our requests, so forget them (except the
+            # ones already received) to be able to ask for them again
+            for piece_index in list(self.requested_pieces):
+                if piece_index not in self.file_manager.pending_pieces:
+                    self.requested_pieces.pop(piece_index, None)
         elif msg.msg_type == Message.UNCHOKE:
             log_unchoking(self.my_peer_id, self.other_peer_id)
             self.they_are_choking_me = False
@@ -199,56 +390,117 @@ class ConnectionHandler(threading.Thread):
 
         elif msg.msg_type == Message.HAVE:
             piece_index = msg.parse_have_payload()
-            self.their_bitfield.set_piece(piece_index)
+            num_new = self.add_their_pieces([piece_index])
 
             log_receive_have(self.my_peer_id, self.other_peer_id, piece_index)
-
-            self.peer_manager.update_peer_bitfield(
-                self.other_peer_id, self.their_bitfield
-            )
-            if not self.am_interested_in_them:
-                if self.file_manager.check_interest(self.their_bitfield):
-                    self.am_interested_in_them = True
-                    self.send_interested()
+            self.on_their_pieces_changed(num_new)
+            if self.peer_manager.super_seeder is not None:
+                self.peer_manager.super_seeder.on_peer_has(self, [piece_index])
+        elif msg.msg_type == Message.HAVE_BATCH:
+            piece_indices = msg.parse_have_batch_payload()
+            num_new = self.add_their_pieces(piece_indices)
+
+            log_receive_have_batch(self.my_peer_id, self.other_peer_id, piece_indices)
+            self.on_their_pieces_changed(num_new)
+            if self.peer_manager.super_seeder is not None:
+                self.peer_manager.super_seeder.on_peer_has(self, piece_indices)
+        elif msg.msg_type == Message.PEX:
+            if self.extensions & Handshake.EXT_PEX:
+                self.peer_manager.pex.on_pex(self, msg.parse_pex_payload())
         elif msg.msg_type == Message.REQUEST:
             piece_index = msg.parse_request_payload()
             if not self.am_choking_them:
                 self.send_piece_message(piece_index)
         elif msg.msg_type == Message.PIECE:
+            if self.file_manager.seeding:
+                return  # late answer to a request, we have every piece
             piece_index, content = msg.parse_piece_payload()
-            if piece_index in self.requested_pieces:
-                self.requested_pieces.remove(piece_index)
-            if self.file_manager.write_piece(piece_index, content):
-                log_download_piece(
-                    self.my_peer_id,
-                    self.other_peer_id,
-                    piece_index,
-                    self.file_manager.num_pieces_have,
-                )
-                self.peer_manager.broadcast_have(piece_index)
+            self.bytes_downloaded += len(content)
+            # The write happens on the disk thread, we keep the piece in
+            # requested_pieces until on_piece_written so it is not asked again.
+            if not self.file_manager.write_piece(
+                piece_index, content, self.on_piece_written
+            ):
+                self.requested_pieces.pop(piece_index, None)
+            self.send_request_message()
 
-                self.peer_manager.update_peer_bitfield(
-                    self.my_peer_id, self.file_manager.bitfield
-                )
+    # Marks pieces in their bitfield and counts the new ones we lack.
+    # Returns how many of the pieces were new to us.
+    def add_their_pieces(self, piece_indices):
+        num_new = 0
+        if self.file_manager.seeding:
+            # none of them can be interesting, only their bitfield matters
+            for piece_index in piece_indices:
+                if not self.their_bitfield.has_piece(piece_index):
+                    self.their_bitfield.set_piece(piece_index)
+                    num_new += 1
+            return num_new
+        with self.file_manager.file_lock:
+            for piece_index in piece_indices:
+                if self.their_bitfield.has_piece(piece_index):
+                    continue  # duplicate HAVE, already counted
+                self.their_bitfield.set_piece(piece_index)
+                num_new += 1
+                if not self.file_manager.bitfield.has_piece(piece_index):
+                    self.num_interesting += 1
+        return num_new
+
+    # After HAVE / HAVE_BATCH: one table update and interest re-check.
+    def on_their_pieces_changed(self, num_new):
+        self.peer_manager.add_peer_pieces(self.other_peer_id, num_new)
+        if not self.file_manager.seeding:
+            self.update_interest()
+
+    # Sends INTERESTED / NOT_INTERESTED only when num_interesting crosses 0.
+    # Only runs on the connection thread, which is the only one selecting
+    # and requesting pieces.
+    def update_interest(self):
+        with self.interest_lock:
+            interested = self.num_interesting > 0
+            if interested != self.am_interested_in_them:
+                self.am_interested_in_them = interested
+                if interested:
+                    self.send_interested()
+                else:
+                    self.send_not_interested()
+        # they may have unchoked us while there was nothing to ask for, also
+        # when we stayed interested (a HAVE came in while our last request was
+        # still on its way to disk)
+        if interested and not self.requested_pieces:
+            self.send_request_message()
+
+    # Called from the disk thread once a received piece is durable.
+    def on_piece_written(self, piece_index, success):
+        self.requested_pieces.pop(piece_index, None)
+        if not success:
+            return
+
+        log_download_piece(
+            self.my_peer_id,
+            self.other_peer_id,
+            piece_index,
+            self.file_manager.num_pieces_have,
+        )
+        self.peer_manager.broadcast_have(piece_index)
+        self.peer_manager.update_interest()
+
+        self.peer_manager.add_peer_pieces(self.my_peer_id, 1)
 
-                if self.file_manager.is_complete():
-                    log_download_complete(self.my_peer_id)
-                self.send_request_message()
+        if self.file_manager.is_complete():
+            log_download_complete(self.my_peer_id)
 
     def send_request_message(self):
-        if self.they_are_choking_me:
+        if self.they_are_choking_me or self.file_manager.seeding:
             return
-        piece_index = self.file_manager.bitfield.select_random_piece(
+        piece_index = self.file_manager.select_piece(
             self.their_bitfield, self.requested_pieces
         )
         if piece_index is not None:
             print(
                 f"[{self.my_peer_id}] Requesting piece {piece_index} from {self.other_peer_id}."
             )
-            self.requested_pieces.add(piece_index)
-            self.conn_socket.sendall(
-                Message.create_request_message(piece_index).to_bytes()
-            )
+            self.requested_pieces[piece_index] = time.monotonic()
+            self._send(Message.encode_request(piece_index))
         else:
             print(
                 f"[{self.my_peer_id}] No pieces to request from {self.other_peer_id}."
@@ -260,26 +512,220 @@ class ConnectionHandler(threading.Thread):
             print(
                 f"[{self.my_peer_id}] Sending PIECE {piece_index} to {self.other_peer_id}."
             )
-            self.conn_socket.sendall(
-                Message.create_piece_message(piece_index, content).to_bytes()
+            self._send_paced(Message.encode_piece(piece_index, content))
+            self.bytes_uploaded += len(content)
+            if self.peer_manager.super_seeder is not None:
+                self.peer_manager.super_seeder.on_piece_sent(self, piece_index)
+
+    # Also called from timer and disk threads. A failed send means the
+    # connection is dead, shutting the socket down makes our own read loop
+    # notice and clean up instead of raising into the caller's thread.
+    def _send(self, data):
+        with self.send_lock:
+            if self.piece_in_flight:
+                self.deferred_sends.append(data)
+                return
+            self._write(data)
+
+    # Called with send_lock held. Returns False if the connection is dead.
+    def _write(self, data):
+        try:
+            self.conn_socket.sendall(data)
+            self.last_sent = time.monotonic()
+            return True
+        except OSError as e:
+            print(f"[{self.my_peer_id}] Send to {self.other_peer_id} failed: {e}")
+            self._shutdown_socket()
+            return False
+
+    # Sends a PIECE frame in PACE_SLICE slices, each one paid for in the per
+    # connection and global upload buckets before it goes out. send_lock is
+    # only held while a slice is written, never while waiting for tokens, so
+    # other threads are not held up by a slow rate limit (their messages are
+    # queued until the frame is complete).
+    def _send_paced(self, data):
+        view = memoryview(data)
+        with self.send_lock:
+            self.piece_in_flight = True
+        alive = True
+        try:
+            for start in range(0, len(view), PACE_SLICE):
+                piece_slice = view[start : start + PACE_SLICE]
+                consume_together(
+                    len(piece_slice),
+                    self.upload_bucket,
+                    self.peer_manager.upload_bucket,
+                )
+                with self.send_lock:
+                    alive = self._write(piece_slice)
+                if not alive:
+                    break
+        finally:
+            with self.send_lock:
+                self.piece_in_flight = False
+                deferred = self.deferred_sends
+                self.deferred_sends = []
+                if deferred and alive:
+                    self._write(b"".join(deferred))
+
+    def _shutdown_socket(self):
+        try:
+            self.conn_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass  # already gone
+
+    # Received bytes are charged after the fact, sleeping here keeps us from
+    # reading the socket so TCP flow control slows the sender down. Paid in
+    # PACE_SLICE steps with keepalives in between, a big piece at a low rate
+    # can take longer than the peer's idle timeout.
+    def _throttle_download(self, num_bytes):
+        if not (
+            self.download_bucket.is_limited()
+            or self.peer_manager.download_bucket.is_limited()
+        ):
+            return
+        keepalive_interval = self.peer_manager.keepalive_interval
+        for start in range(0, num_bytes, PACE_SLICE):
+            consume_together(
+                min(PACE_SLICE, num_bytes - start),
+                self.download_bucket,
+                self.peer_manager.download_bucket,
             )
+            if time.monotonic() - self.last_sent > keepalive_interval:
+                self.send_keepalive()
+
+    def send_keepalive(self):
+        self._send(Message.KEEP_ALIVE_BYTES)
 
     def send_choke(self):
-        self.conn_socket.sendall(Message.create_choke_message().to_bytes())
+        self._send(Message.CHOKE_FRAME)
         self.am_choking_them = True
 
     def send_unchoke(self):
-        self.conn_socket.sendall(Message.create_unchoke_message().to_bytes())
+        self._send(Message.UNCHOKE_FRAME)
         self.am_choking_them = False
 
     def send_have(self, piece_index):
-        self.conn_socket.sendall(Message.create_have_message(piece_index).to_bytes())
+        self._send(Message.encode_have(piece_index))
+
+    # Sends our new pieces, skipping the ones they already own. Those are
+    # kept in suppressed_haves and only sent once flush_suppressed is set.
+    def send_haves(self, piece_indices, flush_suppressed=False):
+        to_send = []
+        for piece_index in piece_indices:
+            if self.their_bitfield.has_piece(piece_index):
+                self.suppressed_haves.append(piece_index)
+            else:
+                to_send.append(piece_index)
+        if flush_suppressed and self.suppressed_haves:
+            to_send += self.suppressed_haves
+            self.suppressed_haves = []
+        if not to_send:
+            return
+
+        if len(to_send) > 1 and self.extensions & Handshake.EXT_HAVE_BATCH:
+            self._send(Message.create_have_batch_message(to_send).to_bytes())
+        else:
+            self._send(
+                b"".join(Message.encode_have(piece_index) for piece_index in to_send)
+            )
+
+    # entries are (peer_id, host, port), see PeerExchange
+    def send_pex(self, entries):
+        self._send(Message.create_pex_message(entries).to_bytes())
 
     def send_interested(self):
-        self.conn_socket.sendall(Message.create_interested_message().to_bytes())
+        self._send(Message.INTERESTED_FRAME)
+
+    def send_not_interested(self):
+        self._send(Message.NOT_INTERESTED_FRAME)
+
 
+# Hot entry points timed in profiling mode, as (class, method, key), see
+# profiler.py. handle_message is split up by message type.
+PROFILED = (
+    (Message, "read_from_socket", None),
+    (ConnectionHandler, "handle_message", lambda handler, msg: msg.type_name()),
+    (ConnectionHandler, "send_request_message", None),
+    (ConnectionHandler, "send_piece_message", None),
+    (FileManager, "select_piece", None),
+    (FileManager, "write_piece", None),
+    (FileManager, "read_piece", None),
+    (FileManager, "_on_piece_written", None),
+    (DiskWriter, "_write_run", None),
+    (PeerManager, "_send_haves", None),
+    (PeerManager, "_check_for_termination", None),
+)
 
-def start_server(my_peer_id, my_port, peer_manager, file_manager):
+
+# kill -USR1 <pid> writes the profile without stopping (no SIGUSR1 on Windows)
+def install_profile_signal():
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: profiler.dump())
+
+
+# Re-reads the rate limit keys from the common config, wired to SIGHUP.
+def reload_rate_limits(peer_manager, common_path):
+    try:
+        config = read_common_config(common_path)
+    except ConfigError as e:
+        print(f"[{peer_manager.my_peer_id}] Not reloading rate limits: {e}")
+        return
+    peer_manager.set_rate_limits(
+        int(config.get("MaxUploadRate", 0)),
+        int(config.get("MaxDownloadRate", 0)),
+        int(config.get("MaxUploadRatePerPeer", 0)),
+        int(config.get("MaxDownloadRatePerPeer", 0)),
+    )
+
+
+# Problems with the file (bad settings, missing or short seed file) are fatal
+# at startup, before any connection is made.
+def create_file_manager(my_peer_info, common_config, shared=None):
+    try:
+        return FileManager(my_peer_info, common_config, shared)
+    except (ValueError, OSError) as e:
+        print(f"FATAL ERROR: {e}")
+        if shared is not None:
+            shared.close()
+        sys.exit(1)
+
+
+# Tracker update: refreshes the live membership, stops redialing peers that
+# left and dials new ones until we have target connections. Like with
+# PeerInfo.cfg only peers "before" us (lower id) are dialed, the others dial us.
+# The tracker lists peers by id, rng shuffles the candidates so that not every
+# peer dials the same lowest ids.
+def join_swarm(peer_manager, connector, peers, complete, target, rng):
+    peer_manager.set_members([peer.peer_id for peer in peers], complete)
+    if peer_manager.pex is not None:
+        peer_manager.pex.add_known(peers)
+
+    live_ids = {peer.peer_id for peer in peers}
+    dialed_ids = connector.dialed_peer_ids()
+    for peer_id in dialed_ids - live_ids:
+        connector.retire(peer_id)
+
+    busy_ids = set(peer_manager.connections) | (dialed_ids & live_ids)
+    candidates = [
+        peer
+        for peer in peers
+        if peer.peer_id < peer_manager.my_peer_id
+        and peer.peer_id not in busy_ids
+        and peer.peer_id not in connector.incompatible_ids
+    ]
+    rng.shuffle(candidates)
+    to_dial = candidates[: max(0, target - len(busy_ids))]
+
+    if connector.phase_start is None:
+        connector.connect_all(to_dial)  # first peer list, logs the connect phase
+    else:
+        for peer in to_dial:
+            connector.connect(peer)
+
+
+# With a coordinator (multi-process mode) accepted sockets go to the workers.
+def start_server(my_peer_id, my_port, peer_manager, file_manager, coordinator=None):
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     try:
@@ -292,6 +738,9 @@ def start_server(my_peer_id, my_port, peer_manager, file_manager):
                 conn, addr = server_socket.accept()
                 server_socket.settimeout(None)
                 print(f"[{my_peer_id}] Accepted connection from {addr}")
+                if coordinator is not None:
+                    coordinator.dispatch(conn, None)
+                    continue
                 handler = ConnectionHandler(
                     conn, my_peer_id, peer_manager, file_manager, None
                 )
@@ -304,76 +753,208 @@ def start_server(my_peer_id, my_port, peer_manager, file_manager):
         server_socket.close()
 
 
+# Entry point of a worker process in multi-process mode (Workers > 0).
+# Runs the ConnectionHandlers for the sockets the main process sends over
+# conn_pipe, see sharding.py.
+def run_shard_worker(
+    worker_index,
+    num_workers,
+    my_peer_info,
+    common_config,
+    all_peers,
+    shared_handle,
+    conn_pipe,
+):
+    my_peer_id = my_peer_info.peer_id
+    setup_logging(my_peer_id, mode="a")
+    if profiler.is_requested(common_config):
+        profiler.enable(f"{my_peer_id}_w{worker_index}", common_config, PROFILED)
+        install_profile_signal()
+
+    # global limits are split evenly between the workers
+    common_config = dict(common_config)
+    for key in ("MaxUploadRate", "MaxDownloadRate"):
+        limit = int(common_config.get(key, 0))
+        if limit > 0:
+            common_config[key] = str(max(1, limit // num_workers))
+
+    shared = SharedState.attach(shared_handle)
+    file_manager = FileManager(my_peer_info, common_config, shared)
+    peer_manager = ShardPeerManager(
+        my_peer_id, all_peers, file_manager, common_config, shared
+    )
+    peer_manager.start_timers()
+    print(f"[{my_peer_id}] Worker {worker_index} started.")
+
+    while not peer_manager.shutdown_event.is_set():
+        try:
+            if not conn_pipe.poll(1.0):
+                continue
+            conn_socket, expected_peer_id = conn_pipe.recv()
+        except (EOFError, OSError):
+            break  # main process is gone
+        handler = ConnectionHandler(
+            conn_socket, my_peer_id, peer_manager, file_manager, expected_peer_id
+        )
+        handler.start()
+
+    # Small delay to allo finish
+    time.sleep(1)
+    file_manager.close()
+    shared.close()
+    profiler.dump()
+    print(f"[{my_peer_id}] Worker {worker_index} stopped.")
+
+
 # --- __main__ (Updated) ---
 if __name__ == "__main__":
 
-    # 1. Parse args and configs
-    # ... (unchanged) ...
-    if len(sys.argv) != 2:
-        print("FATAL ERROR: Missing peer ID argument.")
-        sys.exit(1)
+    # 1. Parse args and configs, everything is validated before any socket
+    # is opened
+    args = parse_args()
+    my_peer_id = args.peer_id
+    print(f"[{my_peer_id}] Starting...")
+    started = time.perf_counter()
     try:
-        my_peer_id = int(sys.argv[1])
-    except ValueError:
-        print(f"FATAL ERROR: Peer ID must be an integer.")
+        common_config = read_common_config(args.common)
+        tracker_address = common_config.get("Tracker")
+        all_peers = read_peer_info(args.peer_info, required=tracker_address is None)
+    except ConfigError as e:
+        print(f"FATAL ERROR: {e}")
         sys.exit(1)
-
-    print(f"[{my_peer_id}] Starting...")
-    common_config = read_common_config()
-    all_peers = read_peer_info_config()
+    print(
+        f"[{my_peer_id}] Loaded {args.common} and {args.peer_info} ({len(all_peers)} peers) "
+        f"in {(time.perf_counter() - started) * 1000:.1f} ms."
+    )
+    if resolve_piece_size(common_config, max(1, len(all_peers))):
+        print(f"[{my_peer_id}] Using piece size {common_config['PieceSize']} (auto).")
 
     # 2. Find our info
-    # ... (unchanged) ...
-    my_peer_info = None
-    peers_to_connect_to = []
-    for peer in all_peers:
-        if peer.peer_id == my_peer_id:
-            my_peer_info = peer
-            break
-        else:
-            peers_to_connect_to.append(peer)
+    # port and has_file from the command line are only used with a tracker,
+    # for peers that are not in the peer info file
+    my_peer_info = all_peers.get(my_peer_id)
+    if my_peer_info is not None:
+        peers_to_connect_to = all_peers.before(my_peer_id)
+    elif tracker_address is not None and args.port is not None:
+        my_peer_info = Peer(my_peer_id, "localhost", args.port, args.has_file)
+        peers_to_connect_to = []
 
     if my_peer_info is None:
-        print(f"FATAL ERROR: Peer ID {my_peer_id} not found in {PEER_INFO_FILE}")
+        print(f"FATAL ERROR: Peer ID {my_peer_id} not found in {args.peer_info}")
         sys.exit(1)
 
+    if args.check:
+        print(f"[{my_peer_id}] Config OK.")
+        sys.exit(0)
+
     # 3. Setup Logger
     setup_logging(my_peer_id)
     print(f"[{my_peer_id}] Logging to log_peer_{my_peer_id}.log")
 
+    if profiler.is_requested(common_config):
+        profiler.enable(my_peer_id, common_config, PROFILED)
+        install_profile_signal()
+
     # 4. Initialize Core Components (Updated)
-    file_manager = FileManager(my_peer_info, common_config)
-    # Give the manager a list of all peers so it knows who to track
-    peer_manager = PeerManager(my_peer_id, all_peers, file_manager, common_config)
+    num_workers = int(common_config.get("Workers", 0))
+    coordinator = None
+    if num_workers > 0:
+        # multi-process mode, connections are served by worker processes
+        mp_context = multiprocessing.get_context("spawn")
+        num_pieces = math.ceil(
+            int(common_config["FileSize"]) / int(common_config["PieceSize"])
+        )
+        shared = SharedState.create(mp_context, num_pieces, all_peers.peer_ids)
+        file_manager = create_file_manager(my_peer_info, common_config, shared)
+        shared.table.set_bitfield(shared.table.slot(my_peer_id), file_manager.bitfield)
+        peer_manager = PeerManager(
+            my_peer_id,
+            all_peers,
+            file_manager,
+            common_config,
+            table=shared.table,
+            shutdown_event=shared.shutdown_event,
+        )
+        peer_manager.pex = None  # the connections live in the workers
+        coordinator = ShardCoordinator(
+            mp_context,
+            peer_manager,
+            shared,
+            num_workers,
+            run_shard_worker,
+            (num_workers, my_peer_info, common_config, all_peers),
+        )
+        coordinator.start()
+        print(f"[{my_peer_id}] Started {num_workers} worker processes.")
+    else:
+        file_manager = create_file_manager(my_peer_info, common_config)
+        # Give the manager a list of all peers so it knows who to track
+        peer_manager = PeerManager(my_peer_id, all_peers, file_manager, common_config)
 
     # 5. Start Server Thread
     # ... (unchanged) ...
     server_thread = threading.Thread(
         target=start_server,
-        args=(my_peer_id, my_peer_info.port, peer_manager, file_manager),
+        args=(my_peer_id, my_peer_info.port, peer_manager, file_manager, coordinator),
         daemon=True,
     )
     server_thread.start()
 
-    for peer_to_connect in peers_to_connect_to:
-        try:
-            client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-            target_host = "127.0.0.1" if LOCAL_TESTING else peer_to_connect.ip_address
-
-            print(f"[{my_peer_id}] Connecting to {peer_to_connect.peer_id}...")
-            client_socket.connect((target_host, peer_to_connect.port))
-            handler = ConnectionHandler(
-                client_socket,
-                my_peer_id,
-                peer_manager,
-                file_manager,
-                peer_to_connect.peer_id,
+    # 6. Connect to the peers before us (from PeerInfo.cfg or the tracker),
+    # concurrently and with retries
+    def start_outbound_handler(conn_socket, peer):
+        if coordinator is not None:
+            return coordinator.dispatch(conn_socket, peer.peer_id)
+        handler = ConnectionHandler(
+            conn_socket, my_peer_id, peer_manager, file_manager, peer.peer_id
+        )
+        handler.start()
+        return handler
+
+    connector = PeerConnector(
+        my_peer_id,
+        common_config,
+        start_outbound_handler,
+        peer_manager.shutdown_event,
+        args.local_testing,
+    )
+    if peer_manager.pex is not None:
+        peer_manager.pex.start(connector.connect, my_peer_info.port)
+
+    tracker_client = None
+    if tracker_address is None:
+        connector.connect_all(peers_to_connect_to)
+    else:
+        target_connections = int(common_config.get("TargetConnections", 8))
+        # seeded by our id, a run can be repeated but peers pick differently
+        dial_rng = random.Random(my_peer_id)
+        tracker_client = TrackerClient(
+            tracker_address,
+            my_peer_info,
+            file_manager,
+            lambda peers, complete: join_swarm(
+                peer_manager, connector, peers, complete, target_connections, dial_rng
+            ),
+        )
+        tracker_client.start()
+
+    # kill -HUP <pid> applies edited rate limits without a restart (no SIGHUP on
+    # Windows). The workers have their own buckets and keep the limits they
+    # were started with, SIGHUP is only acknowledged then (the default action
+    # would kill us).
+    if hasattr(signal, "SIGHUP"):
+        if coordinator is None:
+            signal.signal(
+                signal.SIGHUP,
+                lambda signum, frame: reload_rate_limits(peer_manager, args.common),
+            )
+        else:
+            signal.signal(
+                signal.SIGHUP,
+                lambda signum, frame: print(
+                    f"[{my_peer_id}] Rate limits are not reloaded with Workers, restart to change them."
+                ),
             )
-            handler.start()
-        except Exception as e:
-            print(f"[{my_peer_id}] Failed to connect to {peer_to_connect.peer_id}: {e}")
-            client_socket.close()
 
     print(f"[{my_peer_id}] Starting PeerManager timers...")
     peer_manager.start_timers()
@@ -384,7 +965,15 @@ if __name__ == "__main__":
     peer_manager.shutdown_event.wait()
 
     print(f"[{my_peer_id}] Termination signal received. Shutting down.")
+    if tracker_client is not None:
+        tracker_client.stop()
 
     # Small delay to allo finish
     time.sleep(2)
+    if coordinator is not None:
+        coordinator.stop()
+    file_manager.close()
+    if coordinator is not None:
+        shared.close()
+    profiler.dump()
     sys.exit(0)
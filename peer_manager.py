@@ -2,52 +2,167 @@ import time
 import threading
 import random
 from logger import log_preferred_neighbors, log_optimistic_neighbor
+from rate_limiter import TokenBucket
+from peer_table import PeerTable
+from super_seeder import SuperSeeder
+from pex import PeerExchange
+
+REQUEST_TIMEOUT_PIECE_SIZE = 1 << 20
 
 
 class PeerManager:
     # Added all_peer_info param to track termination state
-    def __init__(self, my_peer_id, all_peers_info, file_manager, common_config):
+    # table / shutdown_event are passed in when they are shared between
+    # processes (see sharding.py)
+    def __init__(
+        self,
+        my_peer_id,
+        all_peers_info,
+        file_manager,
+        common_config,
+        table=None,
+        shutdown_event=None,
+    ):
         self.my_peer_id = my_peer_id
         self.file_manager = file_manager
 
         self.k = int(common_config["NumberOfPreferredNeighbors"])
         self.p_interval = int(common_config["UnchokingInterval"])
         self.m_interval = int(common_config["OptimisticUnchokingInterval"])
+        # how preferred neighbors are picked once we have the file:
+        # random (spec) or upload (the peers we upload to fastest)
+        self.seed_choking = common_config.get("SeedChoking", "random")
+
+        # dead connection detection, all in seconds
+        self.keepalive_interval = int(common_config.get("KeepAliveInterval", 30))
+        self.idle_timeout = int(common_config.get("IdleTimeout", 120))
+        # RequestTimeout is for pieces up to 1 MiB, bigger (auto sized) pieces
+        # take proportionally longer to arrive over the same link
+        self.request_timeout = int(common_config.get("RequestTimeout", 60)) * max(
+            1, file_manager.piece_size / REQUEST_TIMEOUT_PIECE_SIZE
+        )
+
+        # bandwidth limits in bytes/sec, 0 means unlimited
+        self.upload_bucket = TokenBucket()
+        self.download_bucket = TokenBucket()
+        self.per_peer_upload_rate = 0
+        self.per_peer_download_rate = 0
+
+        # HAVEs are collected for this long and sent as one batch, 0 sends
+        # every HAVE right away
+        self.have_batch_delay = float(common_config.get("HaveBatchDelay", 0.05))
+        self.pending_haves = []
+        self.have_cond = threading.Condition()
 
         self.connections = {}
         self.preferred_neighbors = set()
         self.optimistic_neighbor = None
 
         self.all_peers_info = all_peers_info
-
-        # store all bitfields
-        self.peer_bitfields = {
-            p.peer_id: file_manager.bitfield if p.peer_id == my_peer_id else None
-            for p in all_peers_info
-        }
-        self.shutdown_event = threading.Event()
+        self.static_peer_ids = [peer_info.peer_id for peer_info in all_peers_info]
+        # with a tracker: live member ids (us excluded) and the ones the
+        # tracker saw complete. None means the static PeerInfo.cfg list.
+        self.members = None
+        self.members_complete = set()
+        # every peer we were connected to, a peer can join, finish and leave
+        # between two of our announces and never show up in members
+        self.seen_peer_ids = set()
+
+        # per-peer state (bitfields, piece counts, choke/interest flags)
+        if table is None:
+            table = PeerTable(file_manager.num_pieces)
+            for peer_id in self.static_peer_ids:
+                table.slot(peer_id)
+            table.set_bitfield(table.slot(my_peer_id), file_manager.bitfield)
+        self.table = table
+        self.shutdown_event = shutdown_event or threading.Event()
 
         self.lock = threading.Lock()
+        # held for a whole choke round, including the sends
+        self.choke_lock = threading.Lock()
+
+        file_manager.piece_added_hooks.append(self._count_own_piece)
+
+        # peer exchange, started from peerProcess once the connector exists
+        self.pex = None
+        if common_config.get("Pex", "1") == "1":
+            self.pex = PeerExchange(self, common_config)
+            self.pex.add_known(all_peers_info)
+
+        # only the initial seeder super-seeds, see super_seeder.py
+        self.super_seeder = None
+        if common_config.get("SuperSeeding", "0") == "1" and file_manager.is_complete():
+            self.super_seeder = SuperSeeder(
+                self,
+                file_manager,
+                int(common_config.get("SuperSeedPatience", 10)),
+                int(common_config.get("SuperSeedOffers", 8)),
+            )
+
+        self.set_rate_limits(
+            int(common_config.get("MaxUploadRate", 0)),
+            int(common_config.get("MaxDownloadRate", 0)),
+            int(common_config.get("MaxUploadRatePerPeer", 0)),
+            int(common_config.get("MaxDownloadRatePerPeer", 0)),
+        )
 
         print(f"[{my_peer_id}] PeerManager initialized.")
 
+    # Can be called at any time, existing connections pick up the new
+    # per-peer rates right away. None leaves a limit unchanged.
+    def set_rate_limits(
+        self, upload=None, download=None, per_peer_upload=None, per_peer_download=None
+    ):
+        if upload is not None:
+            self.upload_bucket.set_rate(upload)
+        if download is not None:
+            self.download_bucket.set_rate(download)
+        with self.lock:
+            if per_peer_upload is not None:
+                self.per_peer_upload_rate = per_peer_upload
+            if per_peer_download is not None:
+                self.per_peer_download_rate = per_peer_download
+            for handler in self.connections.values():
+                handler.upload_bucket.set_rate(self.per_peer_upload_rate)
+                handler.download_bucket.set_rate(self.per_peer_download_rate)
+        print(
+            f"[{self.my_peer_id}] Rate limits (B/s, 0 = unlimited): "
+            f"up {self.upload_bucket.rate}, down {self.download_bucket.rate}, "
+            f"per peer up {self.per_peer_upload_rate}, down {self.per_peer_download_rate}"
+        )
+
     def add_connection(self, peer_id, handler_thread):
         with self.lock:
+            handler_thread.slot = self.table.slot(peer_id)
+            self.table.reset_connection(handler_thread.slot)
+            self.table.connected[handler_thread.slot] = 1
             self.connections[peer_id] = handler_thread
+            self.seen_peer_ids.add(peer_id)
         print(f"[{self.my_peer_id}] PeerManager registered connection with {peer_id}.")
 
-    def remove_connection(self, peer_id):
+    # handler_thread is checked so a stale handler (peer already reconnected)
+    # does not remove the new connection.
+    def remove_connection(self, peer_id, handler_thread):
         with self.lock:
-            if peer_id in self.connections:
-                del self.connections[peer_id]
+            if self.connections.get(peer_id) is not handler_thread:
+                return
+            del self.connections[peer_id]
+            self.table.connected[handler_thread.slot] = 0
             self.preferred_neighbors.discard(peer_id)
             if self.optimistic_neighbor == peer_id:
                 self.optimistic_neighbor = None
+            # with a tracker it may have been the last one we waited for
+            if self.members is not None:
+                self._check_for_termination()
         print(f"[{self.my_peer_id}] PeerManager removed connection with {peer_id}.")
 
     def start_timers(self):
         threading.Thread(target=self._preferred_neighbor_timer, daemon=True).start()
         threading.Thread(target=self._optimistic_neighbor_timer, daemon=True).start()
+        if self.have_batch_delay > 0:
+            threading.Thread(target=self._have_flusher, daemon=True).start()
+        if self.super_seeder is not None:
+            self.super_seeder.start()
 
     # def _preferred_neighbor_timer(self):
     #     while not self.shutdown_event.is_set():
@@ -115,41 +230,84 @@ class PeerManager:
     def _preferred_neighbor_timer(self):
         while True:
             time.sleep(self.p_interval)
+            self.update_preferred_neighbors()
+
+    def _optimistic_neighbor_timer(self):
+        while True:
+            time.sleep(self.m_interval)
+            self.update_optimistic_neighbor()
+
+    # One choke round, every p_interval seconds. Also driven on virtual time
+    # by simulator.py. The decision is made under self.lock, the messages are
+    # sent after it is released, a slow socket must not hold up the other
+    # connections. choke_lock keeps the two rounds from crossing messages.
+    def update_preferred_neighbors(self):
+        with self.choke_lock:
             with self.lock:
-                interested_peers = []
-                for peer_id, handler in self.connections.items():
-                    if handler.is_interested_in_me:
-                        rate = handler.get_download_rate()
-                        interested_peers.append((rate, peer_id))
-                interested_peers.sort(key=lambda x: x[0], reverse=True)
-                new_preferred_set = {
-                    peer_id for rate, peer_id in interested_peers[: self.k]
-                }
-
-                if self.file_manager.num_pieces_have == self.file_manager.num_pieces:
-                    print(
-                        f"[{self.my_peer_id}] (File complete, selecting neighbors randomly)"
-                    )
-                    interested_ids = [pid for rate, pid in interested_peers]
-                    random.shuffle(interested_ids)
-                    new_preferred_set = set(interested_ids[: self.k])
+                if self.file_manager.is_complete():
+                    new_preferred_set = self._choose_seed_neighbors()
+                else:
+                    interested_peers = []
+                    for peer_id, handler in self.connections.items():
+                        if handler.is_interested_in_me:
+                            rate = handler.get_download_rate()
+                            interested_peers.append((rate, peer_id))
+                    interested_peers.sort(key=lambda x: x[0], reverse=True)
+                    new_preferred_set = {
+                        peer_id for rate, peer_id in interested_peers[: self.k]
+                    }
 
                 peers_to_unchoke = new_preferred_set - self.preferred_neighbors
                 peers_to_choke = self.preferred_neighbors - new_preferred_set
 
+                # a peer may have been dropped while we were ranking
+                to_unchoke = []
+                to_choke = []
                 for peer_id in peers_to_unchoke:
-                    if self.connections[peer_id].am_choking_them:
-                        self.connections[peer_id].send_unchoke()
+                    if (
+                        peer_id in self.connections
+                        and self.connections[peer_id].am_choking_them
+                    ):
+                        to_unchoke.append(self.connections[peer_id])
                 for peer_id in peers_to_choke:
-                    if peer_id != self.optimistic_neighbor:
+                    if (
+                        peer_id in self.connections
+                        and peer_id != self.optimistic_neighbor
+                    ):
                         if not self.connections[peer_id].am_choking_them:
-                            self.connections[peer_id].send_choke()
+                            to_choke.append(self.connections[peer_id])
                 self.preferred_neighbors = new_preferred_set
-                log_preferred_neighbors(self.my_peer_id, list(new_preferred_set))
 
-    def _optimistic_neighbor_timer(self):
-        while True:
-            time.sleep(self.m_interval)
+            for handler in to_unchoke:
+                handler.send_unchoke()
+            for handler in to_choke:
+                handler.send_choke()
+            log_preferred_neighbors(self.my_peer_id, list(new_preferred_set))
+
+    # With the complete file there is nothing to reciprocate, download rates
+    # are not even looked at. Called with self.lock held.
+    def _choose_seed_neighbors(self):
+        interested_ids = [
+            peer_id
+            for peer_id, handler in self.connections.items()
+            if handler.is_interested_in_me
+        ]
+        if self.seed_choking == "upload":
+            # fastest takers first, so our upload stays busy (ties random)
+            ranked = [
+                (self.connections[peer_id].get_upload_rate(), random.random(), peer_id)
+                for peer_id in interested_ids
+            ]
+            ranked.sort(reverse=True)
+            return {peer_id for _, _, peer_id in ranked[: self.k]}
+
+        print(f"[{self.my_peer_id}] (File complete, selecting neighbors randomly)")
+        random.shuffle(interested_ids)
+        return set(interested_ids[: self.k])
+
+    # Every m_interval seconds, sends outside self.lock like above.
+    def update_optimistic_neighbor(self):
+        with self.choke_lock:
             with self.lock:
                 eligible_peers = []
                 for peer_id, handler in self.connections.items():
@@ -159,53 +317,135 @@ class PeerManager:
                         and peer_id not in self.preferred_neighbors
                     ):  # careful.. do not pick preferred neightbor
                         eligible_peers.append(peer_id)
-
-                if eligible_peers:
-                    new_optimistic_neighbor = random.choice(eligible_peers)
-                    if (
-                        self.optimistic_neighbor
-                        and self.optimistic_neighbor not in self.preferred_neighbors
-                        and not self.connections[
-                            self.optimistic_neighbor
-                        ].am_choking_them
-                    ):
-                        self.connections[self.optimistic_neighbor].send_choke()
-                    self.optimistic_neighbor = new_optimistic_neighbor
-                    if self.connections[self.optimistic_neighbor].am_choking_them:
-                        self.connections[self.optimistic_neighbor].send_unchoke()
-                    log_optimistic_neighbor(self.my_peer_id, self.optimistic_neighbor)
-
-    # Broadcasts to all pieces what current pieces it has
+                if not eligible_peers:
+                    return
+
+                new_optimistic_neighbor = random.choice(eligible_peers)
+                to_choke = None
+                if (
+                    self.optimistic_neighbor in self.connections
+                    and self.optimistic_neighbor not in self.preferred_neighbors
+                    and not self.connections[self.optimistic_neighbor].am_choking_them
+                ):
+                    to_choke = self.connections[self.optimistic_neighbor]
+                self.optimistic_neighbor = new_optimistic_neighbor
+                to_unchoke = self.connections[new_optimistic_neighbor]
+
+            if to_choke is not None:
+                to_choke.send_choke()
+            if to_unchoke.am_choking_them:
+                to_unchoke.send_unchoke()
+            log_optimistic_neighbor(self.my_peer_id, new_optimistic_neighbor)
+
+    # Broadcasts to all pieces what current pieces it has.
+    # With batching on the piece is queued for _have_flusher. The last piece
+    # is sent right away together with everything still queued: termination
+    # can be triggered as soon as our own row is counted (see
+    # on_piece_written), and the others must have seen us complete by then.
     def broadcast_have(self, piece_index):
-        print(f"[{self.my_peer_id}] Broadcasting HAVE {piece_index} to all peers.")
-        with self.lock:
-            for peer_id, handler in self.connections.items():
-                handler.send_have(piece_index)
+        if self.have_batch_delay <= 0 or self.file_manager.is_complete():
+            with self.have_cond:
+                batch = self.pending_haves + [piece_index]
+                self.pending_haves = []
+            self._send_haves(batch)
+            return
+        with self.have_cond:
+            self.pending_haves.append(piece_index)
+            self.have_cond.notify()
+
+    # Sends what is queued one last time on shutdown instead of dropping it.
+    def _have_flusher(self):
+        while True:
+            with self.have_cond:
+                while not self.pending_haves and not self.shutdown_event.is_set():
+                    self.have_cond.wait(1.0)
+            # let more pieces pile up
+            self.shutdown_event.wait(self.have_batch_delay)
+            with self.have_cond:
+                batch = self.pending_haves
+                self.pending_haves = []
+            if batch:
+                self._send_haves(batch)
+            if self.shutdown_event.is_set():
+                return
 
-    # Called by a ConnectionHandler when it receives a
-    # BITFIELD or HAVE message.
+    def _send_haves(self, piece_indices):
+        # once we are complete every peer must learn about all our pieces,
+        # including the ones suppressed earlier, or it can not terminate
+        complete = self.file_manager.is_complete()
+        print(f"[{self.my_peer_id}] Broadcasting HAVE {piece_indices} to all peers.")
+        with self.lock:
+            handlers = list(self.connections.values())
+        for handler in handlers:
+            handler.send_haves(piece_indices, complete)
+
+    # Runs under file_manager.file_lock when we get a piece: every peer that has
+    # it now has one interesting piece less. Not taking self.lock here, the
+    # dict is copied instead (lock order is self.lock -> file_lock elsewhere).
+    def _count_own_piece(self, piece_index):
+        for handler in list(self.connections.values()):
+            if handler.their_bitfield.has_piece(piece_index):
+                handler.num_interesting -= 1
+
+    # Called after our piece is durable, on the disk thread. Only flags the
+    # connections: each one sends NOT_INTERESTED (or its next request) from
+    # its own thread, so piece selection never runs on two threads and a slow
+    # socket does not hold up the disk.
+    def update_interest(self):
+        for handler in list(self.connections.values()):
+            handler.interest_changed = True
+
+    # Called by a ConnectionHandler when it receives a BITFIELD message.
     def update_peer_bitfield(self, peer_id, bitfield):
         with self.lock:
-            self.peer_bitfields[peer_id] = bitfield
+            self.table.set_bitfield(self.table.slot(peer_id), bitfield)
             self._check_for_termination()
 
-    # Checks if all peers (from the original PeerInfo.cfg)
-    # have the complete file. If so, triggers shutdown.
-    def _check_for_termination(self):
-        num_pieces = self.file_manager.num_pieces
-
-        for peer_info in self.all_peers_info:
-            peer_id = peer_info.peer_id
-            bfield = self.peer_bitfields.get(peer_id)
+    # Called when a peer (or we) got num_new_pieces more pieces, the bitfield
+    # object itself is already updated by the caller.
+    def add_peer_pieces(self, peer_id, num_new_pieces):
+        with self.lock:
+            self.table.add_pieces(self.table.slot(peer_id), num_new_pieces)
+            self._check_for_termination()
 
-            if bfield is None:  # if we dont have bietfield we aint done
-                return
+    # Called with every peer list from the tracker. Peers that left no longer
+    # hold up termination, peers that joined do.
+    def set_members(self, peer_ids, complete_ids):
+        with self.lock:
+            self.members = set(peer_ids)
+            self.members_complete = set(complete_ids)
+            self._check_for_termination()
 
-            # double check each piece is present
-            for i in range(num_pieces):
-                if not bfield.has_piece(i):
-                    return  # found a peer that is not donw
+    # Checks if all peers (from the original PeerInfo.cfg, or the live members
+    # when using a tracker) have the complete file. If so, triggers shutdown.
+    # With a tracker the peers connected to us count too, the tracker may not
+    # have told us about them yet.
+    def _check_for_termination(self):
+        if self.members is None:
+            peer_ids = self.static_peer_ids
+        else:
+            peer_ids = {self.my_peer_id, *self.members, *self.connections}
+            if len(peer_ids) == 1 and not self._saw_peer_complete():
+                return  # nobody else joined (yet), keep seeding
+
+        for peer_id in peer_ids:
+            if peer_id in self.members_complete:
+                continue
+            slot = self.table.slot_of.get(peer_id)
+            if slot is None or not self.table.is_complete(slot):
+                return  # found a peer that is not donw
 
         # this means it has passed all checks.
         print(f"[{self.my_peer_id}] All peers have completed the download!")
         self.shutdown_event.set()
+
+    # True if a peer we were connected to got the complete file (it may have
+    # left since). Called with self.lock held.
+    def _saw_peer_complete(self):
+        for peer_id in self.seen_peer_ids:
+            if peer_id in self.members_complete:
+                return True
+            slot = self.table.slot_of.get(peer_id)
+            if slot is not None and self.table.is_complete(slot):
+                return True
+        return False
@@ -0,0 +1,110 @@
+from array import array
+
+
+# Per-peer state kept as struct-of-arrays instead of attributes spread over
+# every ConnectionHandler. Each peer id gets a slot (an index into the arrays)
+# the first time it is seen, a peer that reconnects gets its old slot back.
+#
+# - bitfields:        latest Bitfield we know for the peer (or None)
+# - piece_counts:     number of pieces set in that bitfield
+# - am_choking:       1 if we are choking the peer
+# - interested_in_me: 1 if the peer told us it is interested
+# - bytes_downloaded: bytes received from the peer since the last rate check
+# - bytes_uploaded:   piece bytes sent to the peer since the last rate check
+# - connected:        1 while a ConnectionHandler for the peer is registered
+#
+# fixed() builds a table with a fixed set of peers on top of existing
+# buffers, used to share it between processes (see sharding.py).
+class PeerTable:
+
+    __slots__ = (
+        "num_pieces",
+        "slot_of",
+        "peer_ids",
+        "bitfields",
+        "piece_counts",
+        "am_choking",
+        "interested_in_me",
+        "bytes_downloaded",
+        "bytes_uploaded",
+        "connected",
+        "is_fixed",
+    )
+
+    def __init__(self, num_pieces):
+        self.num_pieces = num_pieces
+        self.slot_of = {}
+        self.peer_ids = array("q")
+        self.bitfields = []
+        self.piece_counts = array("I")
+        self.am_choking = bytearray()
+        self.interested_in_me = bytearray()
+        self.bytes_downloaded = array("Q")
+        self.bytes_uploaded = array("Q")
+        self.connected = bytearray()
+        self.is_fixed = False
+
+    # columns are writable buffers with one entry per peer in peer_ids,
+    # e.g. memoryview casts of shared memory
+    @classmethod
+    def fixed(
+        cls,
+        num_pieces,
+        peer_ids,
+        piece_counts,
+        am_choking,
+        interested_in_me,
+        bytes_downloaded,
+        bytes_uploaded,
+        connected,
+    ):
+        table = cls(num_pieces)
+        table.peer_ids = array("q", peer_ids)
+        table.slot_of = {peer_id: slot for slot, peer_id in enumerate(peer_ids)}
+        table.bitfields = [None] * len(peer_ids)
+        table.piece_counts = piece_counts
+        table.am_choking = am_choking
+        table.interested_in_me = interested_in_me
+        table.bytes_downloaded = bytes_downloaded
+        table.bytes_uploaded = bytes_uploaded
+        table.connected = connected
+        table.is_fixed = True
+        return table
+
+    def __len__(self):
+        return len(self.peer_ids)
+
+    # Returns the slot for peer_id, adding the peer if needed.
+    def slot(self, peer_id):
+        slot = self.slot_of.get(peer_id)
+        if slot is None:
+            if self.is_fixed:
+                raise KeyError(f"Peer {peer_id} is not in the peer table.")
+            slot = len(self.peer_ids)
+            self.slot_of[peer_id] = slot
+            self.peer_ids.append(peer_id)
+            self.bitfields.append(None)
+            self.piece_counts.append(0)
+            self.am_choking.append(1)
+            self.interested_in_me.append(0)
+            self.bytes_downloaded.append(0)
+            self.bytes_uploaded.append(0)
+            self.connected.append(0)
+        return slot
+
+    # Connection state starts over for every new connection.
+    def reset_connection(self, slot):
+        self.am_choking[slot] = 1
+        self.interested_in_me[slot] = 0
+        self.bytes_downloaded[slot] = 0
+        self.bytes_uploaded[slot] = 0
+
+    def set_bitfield(self, slot, bitfield):
+        self.bitfields[slot] = bitfield
+        self.piece_counts[slot] = bitfield.count()
+
+    def add_pieces(self, slot, num_new_pieces):
+        self.piece_counts[slot] += num_new_pieces
+
+    def is_complete(self, slot):
+        return self.piece_counts[slot] == self.num_pieces
@@ -0,0 +1,117 @@
+import threading
+import time
+
+from logger import log_receive_pex
+from message import Handshake
+from peer import Peer
+
+
+# Peer exchange (PEX): connected peers gossip the addresses they know, so
+# the swarm can grow past the peers listed in PeerInfo.cfg / returned by the
+# tracker. Only used with peers that set Handshake.EXT_PEX.
+#
+# - Every PexInterval seconds each connection gets one PEX message with the
+#   addresses it was not sent yet (at most PexMaxPeers), our own entry first.
+# - A PEX message arriving sooner than half an interval after the previous
+#   one from the same peer is dropped.
+# - New peers with a lower id are dialed (the usual rule, the others dial
+#   us) while we have fewer than PexMaxConnections connections.
+class PeerExchange:
+    def __init__(self, peer_manager, common_config):
+        self.peer_manager = peer_manager
+        self.my_peer_id = peer_manager.my_peer_id
+        self.interval = float(common_config.get("PexInterval", 30))
+        self.max_peers = int(common_config.get("PexMaxPeers", 50))
+        self.max_connections = int(common_config.get("PexMaxConnections", 30))
+
+        self.lock = threading.Lock()
+        self.known = {}  # peer id -> Peer, our address book
+        self.sent = {}  # peer id -> peer ids that connection knows about
+        self.last_received = {}  # peer id -> time.monotonic() of their last PEX
+
+        self.my_port = None
+        self.connect = None  # PeerConnector.connect, set in start()
+
+    def start(self, connect, my_port):
+        self.connect = connect
+        self.my_port = my_port
+        threading.Thread(target=self._gossip_timer, daemon=True).start()
+
+    # Adds peers to the address book, returns the ones that were new.
+    def add_known(self, peers):
+        new_peers = []
+        with self.lock:
+            for peer in peers:
+                if peer.peer_id == self.my_peer_id or peer.peer_id in self.known:
+                    continue
+                self.known[peer.peer_id] = peer
+                new_peers.append(peer)
+        return new_peers
+
+    def remove_peer(self, peer_id):
+        with self.lock:
+            self.sent.pop(peer_id, None)
+            self.last_received.pop(peer_id, None)
+
+    def on_pex(self, handler, entries):
+        peer_id = handler.other_peer_id
+        now = time.monotonic()
+        with self.lock:
+            last = self.last_received.get(peer_id)
+            if last is not None and now - last < self.interval / 2:
+                print(f"[{self.my_peer_id}] Dropped PEX from {peer_id}, too soon.")
+                return
+            self.last_received[peer_id] = now
+            # no need to tell them about peers they just told us about
+            self.sent.setdefault(peer_id, set()).update(entry[0] for entry in entries)
+
+        peers = []
+        for entry_peer_id, host, port in entries:
+            if not host:
+                # their own entry, reachable where we see them
+                try:
+                    host = handler.conn_socket.getpeername()[0]
+                except OSError:
+                    continue
+            peers.append(Peer(entry_peer_id, host, port, 0))
+        new_peers = self.add_known(peers)
+        log_receive_pex(
+            self.my_peer_id,
+            peer_id,
+            len(entries),
+            [peer.peer_id for peer in new_peers],
+        )
+        self._dial(new_peers)
+
+    def _dial(self, peers):
+        if self.connect is None:
+            return
+        connections = self.peer_manager.connections
+        for peer in peers:
+            if len(connections) >= self.max_connections:
+                break
+            if peer.peer_id < self.my_peer_id and peer.peer_id not in connections:
+                self.connect(peer)
+
+    def _gossip_timer(self):
+        shutdown_event = self.peer_manager.shutdown_event
+        while not shutdown_event.wait(self.interval):
+            for handler in list(self.peer_manager.connections.values()):
+                if handler.extensions & Handshake.EXT_PEX:
+                    self._send_to(handler)
+
+    def _send_to(self, handler):
+        peer_id = handler.other_peer_id
+        with self.lock:
+            sent = self.sent.setdefault(peer_id, set())
+            entries = []
+            if self.my_peer_id not in sent:
+                entries.append((self.my_peer_id, "", self.my_port))
+            for known_id, peer in self.known.items():
+                if len(entries) >= self.max_peers:
+                    break
+                if known_id != peer_id and known_id not in sent:
+                    entries.append((known_id, peer.ip_address, peer.port))
+            sent.update(entry[0] for entry in entries)
+        if entries:
+            handler.send_pex(entries)
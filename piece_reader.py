@@ -0,0 +1,101 @@
+import io
+import os
+import threading
+import time
+
+
+# File-like view on the file being downloaded, see FileManager.open_reader().
+#
+# read() blocks until the piece at the current position is on disk and then
+# returns as many contiguous bytes as are available (up to the size asked
+# for), so a consumer can process the file while it is still downloading.
+# Works best with PieceSelection sequential. chunks() is the same as a
+# blocking iterator.
+#
+# Pieces are only in the bitfield once they are durable (see DiskWriter), so
+# whatever the bitfield says is there can be read from the file.
+class PieceReader(io.RawIOBase):
+
+    # also picks up pieces written by other worker processes, those do not
+    # run our hooks
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, file_manager, timeout=None):
+        super().__init__()
+        self.file_manager = file_manager
+        self.timeout = timeout  # seconds without new data before TimeoutError
+        self.position = 0
+        self.cond = threading.Condition()
+        self.fd = os.open(
+            file_manager.file_path, os.O_RDONLY | getattr(os, "O_BINARY", 0)
+        )
+        with file_manager.file_lock:
+            file_manager.piece_added_hooks.append(self._on_piece_added)
+
+    def readable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    # piece_added_hook, runs under file_manager.file_lock
+    def _on_piece_added(self, piece_index):
+        with self.cond:
+            self.cond.notify_all()
+
+    # Bytes that can be read from self.position without waiting, counting at
+    # most up to limit.
+    def available(self, limit=None):
+        fm = self.file_manager
+        if limit is None:
+            limit = fm.file_size
+        end = min(self.position + limit, fm.file_size)
+        piece_index = self.position // fm.piece_size
+        while piece_index * fm.piece_size < end and fm.bitfield.has_piece(piece_index):
+            piece_index += 1
+        return max(0, min(piece_index * fm.piece_size, end) - self.position)
+
+    def readinto(self, buffer):
+        if self.closed:
+            raise ValueError("I/O operation on closed reader.")
+        if self.position >= self.file_manager.file_size or len(buffer) == 0:
+            return 0
+
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        with self.cond:
+            while True:
+                num_bytes = self.available(len(buffer))
+                if num_bytes > 0:
+                    break
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise TimeoutError(
+                        f"No data at offset {self.position} after {self.timeout}s."
+                    )
+                self.cond.wait(self.POLL_INTERVAL)
+
+        data = self._pread(num_bytes, self.position)
+        buffer[: len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    # Yields the file as contiguous chunks, each as soon as it is complete.
+    def chunks(self, max_size=1 << 20):
+        while True:
+            data = self.read(max_size)
+            if not data:
+                return
+            yield data
+
+    def close(self):
+        if self.closed:
+            return
+        with self.file_manager.file_lock:
+            self.file_manager.piece_added_hooks.remove(self._on_piece_added)
+        os.close(self.fd)
+        super().close()
+
+    def _pread(self, num_bytes, offset):
+        if hasattr(os, "pread"):
+            return os.pread(self.fd, num_bytes, offset)
+        os.lseek(self.fd, offset, os.SEEK_SET)  # Windows has no pread
+        return os.read(self.fd, num_bytes)
@@ -0,0 +1,175 @@
+import functools
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+
+# Profiling mode, off by default. Enabled with Profile 1 in Common.cfg or the
+# P2P_PROFILE=1 environment variable.
+#
+# - enable() wraps the hot entry points (see peerProcess.PROFILED) with
+#   timers. Nothing is wrapped while disabled, so the normal path pays nothing.
+# - Every timer feeds a histogram with power of two buckets in microseconds,
+#   handle_message gets one histogram per message type.
+# - A sampling thread looks at every thread's stack every SampleInterval
+#   seconds and counts the innermost frames, which also shows time spent
+#   outside the wrapped functions (waiting on locks, sleeping in buckets...).
+# - dump() writes everything, plus the current stack of every thread, to
+#   profile_peer_<id>.txt. It is called on SIGUSR1 and on exit.
+
+ENV_VAR = "P2P_PROFILE"
+NUM_BUCKETS = 32  # 2^31 us is about 36 minutes, plenty
+
+
+class Histogram:
+    __slots__ = ("lock", "count", "total", "max", "buckets")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * NUM_BUCKETS
+
+    def add(self, seconds):
+        # bucket i holds durations below 2^i us
+        bucket = min(int(seconds * 1e6).bit_length(), NUM_BUCKETS - 1)
+        with self.lock:
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+            self.buckets[bucket] += 1
+
+    # upper bound (in us) of the bucket holding the given fraction of samples
+    def percentile(self, fraction):
+        target = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= target:
+                return 1 << bucket
+        return 0
+
+
+class Profiler:
+    def __init__(self):
+        self.enabled = False
+        self.peer_id = None
+        self.lock = threading.Lock()
+        self.histograms = {}  # name -> Histogram
+        self.samples = Counter()  # (file, line, function) -> count
+        self.num_samples = 0
+        self.sample_interval = 0.01
+        self.started = None
+
+    @staticmethod
+    def is_requested(common_config):
+        return (
+            os.environ.get(ENV_VAR, "0") == "1" or common_config.get("Profile") == "1"
+        )
+
+    def enable(self, peer_id, common_config, targets):
+        self.enabled = True
+        self.peer_id = peer_id
+        self.started = time.monotonic()
+        self.sample_interval = float(common_config.get("SampleInterval", 0.01))
+        for cls, method_name, key in targets:
+            self.wrap(cls, method_name, key)
+        if self.sample_interval > 0:
+            threading.Thread(target=self._sampler, daemon=True).start()
+        print(f"[{peer_id}] Profiling enabled, dump with SIGUSR1.")
+
+    def record(self, name, seconds):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(name, Histogram())
+        histogram.add(seconds)
+
+    # Replaces cls.method_name with a timed version. key(*args) can return a
+    # more specific name per call (e.g. the message type).
+    def wrap(self, cls, method_name, key=None):
+        raw = cls.__dict__[method_name]
+        is_static = isinstance(raw, staticmethod)
+        original = raw.__func__ if is_static else raw
+        name = f"{cls.__name__}.{method_name}"
+        record = self.record
+        perf_counter = time.perf_counter
+
+        @functools.wraps(original)
+        def timed(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                label = name if key is None else f"{name}[{key(*args)}]"
+                record(label, perf_counter() - start)
+
+        setattr(cls, method_name, staticmethod(timed) if is_static else timed)
+
+    def _sampler(self):
+        me = threading.get_ident()
+        while True:
+            time.sleep(self.sample_interval)
+            frames = sys._current_frames()
+            with self.lock:
+                self.num_samples += 1
+                for thread_id, frame in frames.items():
+                    if thread_id != me:
+                        code = frame.f_code
+                        self.samples[
+                            (code.co_filename, frame.f_lineno, code.co_name)
+                        ] += 1
+
+    def dump(self, path=None):
+        if not self.enabled:
+            return
+        path = path or f"profile_peer_{self.peer_id}.txt"
+        lines = [
+            f"Profile of peer {self.peer_id}, {time.monotonic() - self.started:.1f}s "
+            f"after start ({time.strftime('%Y-%m-%d %H:%M:%S')})",
+            "",
+            "== Timers (us) ==",
+            f"{'name':<48}{'count':>9}{'mean':>10}{'p50':>9}{'p99':>9}{'max':>10}",
+        ]
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+        for name, h in histograms:
+            if not h.count:
+                continue
+            lines.append(
+                f"{name:<48}{h.count:>9}{h.total / h.count * 1e6:>10.1f}"
+                f"{h.percentile(0.5):>9}{h.percentile(0.99):>9}{h.max * 1e6:>10.0f}"
+            )
+            spread = " ".join(
+                f"<{1 << bucket}:{count}"
+                for bucket, count in enumerate(h.buckets)
+                if count
+            )
+            lines.append(f"    {spread}")
+
+        with self.lock:
+            top = self.samples.most_common(30)
+            num_samples = self.num_samples
+        lines += ["", f"== Sampled frames ({num_samples} samples, all threads) =="]
+        for (filename, lineno, function), count in top:
+            lines.append(
+                f"{count:>8}  {function} ({os.path.basename(filename)}:{lineno})"
+            )
+
+        lines += ["", "== Current stacks =="]
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            lines.append(f"-- {names.get(thread_id, thread_id)}")
+            lines += [line.rstrip() for line in traceback.format_stack(frame)]
+
+        with open(path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        print(f"[{self.peer_id}] Profile written to {path}.")
+
+
+# one per process
+profiler = Profiler()
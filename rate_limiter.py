@@ -0,0 +1,68 @@
+import threading
+import time
+
+
+# Token bucket used to shape upload/download bandwidth.
+#
+# - rate is in bytes per second, 0 (or less) means unlimited.
+# - consume(n) takes n tokens and sleeps until they are "paid for". The bucket
+#   is allowed to go into debt, so callers are served in the order they asked
+#   and a big request does not starve behind a small capacity.
+# - take(n) takes the tokens without sleeping and returns how long to wait,
+#   see consume_together.
+class TokenBucket:
+
+    __slots__ = ("lock", "rate", "capacity", "tokens", "last_refill")
+
+    MIN_BURST = 16384  # at least 16 KiB, even for very low rates
+
+    def __init__(self, rate=0, burst=None):
+        self.lock = threading.Lock()
+        self.rate = 0
+        self.tokens = 0
+        self.last_refill = time.monotonic()
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        """
+        Changes the rate at runtime. Tokens already in the bucket are kept,
+        up to the new burst size.
+        """
+        with self.lock:
+            self._refill()
+            self.rate = max(0, int(rate))
+            if burst is None:
+                burst = max(self.MIN_BURST, self.rate // 4)
+            self.capacity = burst
+            self.tokens = min(self.tokens, self.capacity)
+
+    def is_limited(self):
+        return self.rate > 0
+
+    def consume(self, amount):
+        wait = self.take(amount)
+        if wait > 0:
+            time.sleep(wait)
+
+    def take(self, amount):
+        if self.rate <= 0:
+            return 0
+        with self.lock:
+            self._refill()
+            self.tokens -= amount
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate > 0:
+            elapsed = now - self.last_refill
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.last_refill = now
+
+
+# Charges amount to every bucket at once and sleeps for the longest wait, so
+# a per connection and a global limit do not add up.
+def consume_together(amount, *buckets):
+    wait = max(bucket.take(amount) for bucket in buckets)
+    if wait > 0:
+        time.sleep(wait)
@@ -0,0 +1,360 @@
+import math
+import threading
+import time
+from multiprocessing import shared_memory
+
+from bitfield import Bitfield
+from peer_manager import PeerManager
+from peer_table import PeerTable
+
+# Optional multi-process mode (Workers N in Common.cfg).
+#
+# The main process keeps the listener, the outbound connector and the
+# PeerManager choke timers. Every connected socket is handed to one of N
+# worker processes over a pipe (round robin), and the worker runs the
+# ConnectionHandler for it. What the processes have to agree on lives in one
+# shared memory block:
+#
+#     -----------------------------------------------------------------------
+#    | bytes_downloaded (8n) | bytes_uploaded (8n) | piece_counts (4n) |
+#    | have count (4) | bitfield (b) | pending (b) | am_choking (n) |
+#    | interested (n) | connected (n) |
+#     -----------------------------------------------------------------------
+#
+# (n = number of peers in PeerInfo.cfg, b = bitfield bytes)
+#
+# The main PeerManager stays the only one deciding who is choked: it writes
+# am_choking in the table and the worker owning the connection sends the
+# CHOKE/UNCHOKE message. Workers learn about pieces written by other workers
+# by diffing the shared bitfield.
+
+
+# set-like view of a Bitfield, used as FileManager.pending_pieces when shared
+class SharedPieceSet:
+    __slots__ = ("bitfield",)
+
+    def __init__(self, bitfield):
+        self.bitfield = bitfield
+
+    def __contains__(self, piece_index):
+        return self.bitfield.has_piece(piece_index)
+
+    def add(self, piece_index):
+        self.bitfield.set_piece(piece_index)
+
+    def discard(self, piece_index):
+        self.bitfield.clear_piece(piece_index)
+
+
+# Owns (or attaches to) the shared memory block described above.
+# Use create() in the main process and attach(handle()) in the workers.
+class SharedState:
+    def __init__(self, num_pieces, peer_ids, lock, shutdown_event, name=None):
+        self.num_pieces = num_pieces
+        self.peer_ids = list(peer_ids)
+        self.lock = lock
+        self.shutdown_event = shutdown_event
+        self.owner = name is None
+
+        n = len(self.peer_ids)
+        b = math.ceil(num_pieces / 8)
+        size = 16 * n + 4 * n + 4 + 2 * b + 3 * n
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+
+        # all views are kept so close() can release them
+        self.views = []
+        offset = 0
+
+        def take(length, fmt="B"):
+            nonlocal offset
+            view = self.shm.buf[offset : offset + length]
+            offset += length
+            self.views.append(view)
+            if fmt != "B":
+                view = view.cast(fmt)
+                self.views.append(view)
+            return view
+
+        bytes_downloaded = take(8 * n, "Q")
+        bytes_uploaded = take(8 * n, "Q")
+        piece_counts = take(4 * n, "I")
+        self.have_count = take(4, "I")
+        self.bitfield = take(b)
+        self.pending_pieces = SharedPieceSet(Bitfield.over(num_pieces, take(b)))
+        am_choking = take(n)
+        interested_in_me = take(n)
+        connected = take(n)
+
+        if self.owner:
+            am_choking[:] = bytes([1] * n)
+
+        self.table = PeerTable.fixed(
+            num_pieces,
+            self.peer_ids,
+            piece_counts,
+            am_choking,
+            interested_in_me,
+            bytes_downloaded,
+            bytes_uploaded,
+            connected,
+        )
+
+    @classmethod
+    def create(cls, mp_context, num_pieces, peer_ids):
+        return cls(num_pieces, peer_ids, mp_context.Lock(), mp_context.Event())
+
+    # picklable, passed to the worker processes
+    def handle(self):
+        return (
+            self.num_pieces,
+            self.peer_ids,
+            self.lock,
+            self.shutdown_event,
+            self.shm.name,
+        )
+
+    @classmethod
+    def attach(cls, handle):
+        return cls(*handle)
+
+    def close(self):
+        self.table = None
+        self.pending_pieces = None
+        for view in reversed(self.views):
+            try:
+                view.release()
+            except BufferError:
+                pass  # still referenced somewhere, the OS cleans up on exit
+        try:
+            self.shm.close()
+            if self.owner:
+                self.shm.unlink()
+        except (BufferError, FileNotFoundError):
+            pass
+
+
+# PeerManager used inside a worker process.
+# - choke decisions come from the main process through the shared table
+# - termination is decided by the main process
+# - pieces written by other workers are picked up by diffing the bitfield
+class ShardPeerManager(PeerManager):
+
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, my_peer_id, all_peers_info, file_manager, common_config, shared):
+        super().__init__(
+            my_peer_id,
+            all_peers_info,
+            file_manager,
+            common_config,
+            table=shared.table,
+            shutdown_event=shared.shutdown_event,
+        )
+        self.shared_lock = shared.lock
+        self.pex = None  # workers can not dial, only the main process does
+        if self.super_seeder is not None:
+            # offers are per process, workers would hand out the same pieces
+            print(
+                f"[{my_peer_id}] SuperSeeding is not supported with Workers, ignored."
+            )
+            self.super_seeder = None
+        self.choke_sent = {}  # peer id -> last choke state we sent
+        self.seen_pieces = bytearray(file_manager.bitfield.field)
+        file_manager.piece_added_hooks.append(self._mark_seen)
+
+    def start_timers(self):
+        threading.Thread(target=self._choke_applier, daemon=True).start()
+        threading.Thread(target=self._own_piece_watcher, daemon=True).start()
+        if self.have_batch_delay > 0:
+            threading.Thread(target=self._have_flusher, daemon=True).start()
+
+    def add_connection(self, peer_id, handler_thread):
+        super().add_connection(peer_id, handler_thread)
+        self.choke_sent[peer_id] = True
+
+    def add_peer_pieces(self, peer_id, num_new_pieces):
+        if peer_id != self.my_peer_id:
+            super().add_peer_pieces(peer_id, num_new_pieces)
+            return
+        # our own row is written by every worker
+        with self.shared_lock:
+            self.table.add_pieces(self.table.slot(peer_id), num_new_pieces)
+
+    def _check_for_termination(self):
+        pass  # the main process decides
+
+    # piece_added_hook, our own pieces are handled by the normal path
+    def _mark_seen(self, piece_index):
+        self.seen_pieces[piece_index // 8] |= 128 >> (piece_index % 8)
+
+    def _choke_applier(self):
+        while not self.shutdown_event.is_set():
+            time.sleep(self.POLL_INTERVAL)
+            for peer_id, handler in list(self.connections.items()):
+                choking = handler.am_choking_them
+                if self.choke_sent.get(peer_id) != choking:
+                    self.choke_sent[peer_id] = choking
+                    if choking:
+                        handler.send_choke()
+                    else:
+                        handler.send_unchoke()
+
+    # Also runs once more after shutdown, so the last pieces written by other
+    # workers are still announced on our connections.
+    def _own_piece_watcher(self):
+        field = self.file_manager.bitfield.field
+        stopping = False
+        while not stopping:
+            time.sleep(self.POLL_INTERVAL)
+            stopping = self.shutdown_event.is_set()
+            new_pieces = []
+            with self.file_manager.file_lock:
+                if field == self.seen_pieces:
+                    continue
+                for i in range(len(self.seen_pieces)):
+                    diff = field[i] & ~self.seen_pieces[i] & 0xFF
+                    if not diff:
+                        continue
+                    self.seen_pieces[i] |= diff
+                    for bit in range(8):
+                        if diff & (128 >> bit):
+                            new_pieces.append(i * 8 + bit)
+                for piece_index in new_pieces:
+                    self._count_own_piece(piece_index)
+            for piece_index in new_pieces:
+                self.broadcast_have(piece_index)
+            self.update_interest()
+            # the last piece may have been written by another worker
+            if self.file_manager.is_complete() and not self.file_manager.seeding:
+                self.file_manager.enter_seed_mode()
+
+
+# Stand-in for a ConnectionHandler that lives in a worker process, so the
+# main PeerManager timers can rank and choke it through the shared table.
+class RemoteConnection:
+    __slots__ = ("table", "slot", "start_time", "upload_start_time", "shutdown_event")
+
+    def __init__(self, table, slot, shutdown_event):
+        self.table = table
+        self.slot = slot
+        self.start_time = time.time()
+        self.upload_start_time = time.time()
+        self.shutdown_event = shutdown_event
+
+    @property
+    def is_interested_in_me(self):
+        return self.table.interested_in_me[self.slot] == 1
+
+    @property
+    def am_choking_them(self):
+        return self.table.am_choking[self.slot] == 1
+
+    def get_download_rate(self):
+        # the worker keeps adding while we reset, a few bytes may get lost
+        duration = time.time() - self.start_time
+        if duration == 0:
+            return 0
+        rate = self.table.bytes_downloaded[self.slot] / duration
+        self.table.bytes_downloaded[self.slot] = 0
+        self.start_time = time.time()
+        return rate
+
+    def get_upload_rate(self):
+        duration = time.time() - self.upload_start_time
+        if duration == 0:
+            return 0
+        rate = self.table.bytes_uploaded[self.slot] / duration
+        self.table.bytes_uploaded[self.slot] = 0
+        self.upload_start_time = time.time()
+        return rate
+
+    def send_choke(self):
+        self.table.am_choking[self.slot] = 1
+
+    def send_unchoke(self):
+        self.table.am_choking[self.slot] = 0
+
+    # Waits until the worker has registered and then dropped the connection,
+    # this is what PeerConnector needs to know when to reconnect.
+    def join(self, setup_timeout=30):
+        deadline = time.monotonic() + setup_timeout
+        while not self.table.connected[self.slot]:
+            if time.monotonic() > deadline or self.shutdown_event.is_set():
+                return
+            time.sleep(0.5)
+        while self.table.connected[self.slot] and not self.shutdown_event.is_set():
+            time.sleep(0.5)
+
+
+# Main process side: starts the workers, hands them sockets and mirrors the
+# connections they report into peer_manager.connections as RemoteConnections.
+class ShardCoordinator:
+
+    SYNC_INTERVAL = 0.2
+
+    def __init__(self, mp_context, peer_manager, shared, num_workers, target, args):
+        self.peer_manager = peer_manager
+        self.shared = shared
+        self.workers = []
+        self.pipes = []
+        self.pipe_locks = []
+        self.next_worker = 0
+        for worker_index in range(num_workers):
+            parent_end, child_end = mp_context.Pipe()
+            process = mp_context.Process(
+                target=target,
+                args=(worker_index, *args, shared.handle(), child_end),
+                daemon=True,
+            )
+            self.workers.append(process)
+            self.pipes.append(parent_end)
+            self.pipe_locks.append(threading.Lock())
+
+    def start(self):
+        for process in self.workers:
+            process.start()
+        threading.Thread(target=self._sync_loop, daemon=True).start()
+
+    # Hands the socket to the next worker and closes our copy. For outbound
+    # connections the returned RemoteConnection can be joined.
+    def dispatch(self, conn_socket, expected_peer_id=None):
+        worker_index = self.next_worker
+        self.next_worker = (self.next_worker + 1) % len(self.workers)
+        with self.pipe_locks[worker_index]:
+            self.pipes[worker_index].send((conn_socket, expected_peer_id))
+        conn_socket.close()
+        if expected_peer_id is None:
+            return None
+        table = self.shared.table
+        return RemoteConnection(
+            table, table.slot(expected_peer_id), self.peer_manager.shutdown_event
+        )
+
+    def _sync_loop(self):
+        pm = self.peer_manager
+        table = self.shared.table
+        while not pm.shutdown_event.is_set():
+            time.sleep(self.SYNC_INTERVAL)
+            with pm.lock:
+                for slot, peer_id in enumerate(table.peer_ids):
+                    if peer_id == pm.my_peer_id:
+                        continue
+                    if table.connected[slot] and peer_id not in pm.connections:
+                        pm.connections[peer_id] = RemoteConnection(
+                            table, slot, pm.shutdown_event
+                        )
+                    elif not table.connected[slot] and peer_id in pm.connections:
+                        del pm.connections[peer_id]
+                        pm.preferred_neighbors.discard(peer_id)
+                        if pm.optimistic_neighbor == peer_id:
+                            pm.optimistic_neighbor = None
+                pm._check_for_termination()
+
+    def stop(self, timeout=5):
+        for process in self.workers:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
@@ -0,0 +1,593 @@
+import argparse
+import contextlib
+import heapq
+import itertools
+import math
+import os
+import random
+import sys
+import threading
+import time
+
+from bitfield import Bitfield
+from config import (
+    ConfigError,
+    read_common_config,
+    resolve_piece_size,
+    validate_common_config,
+)
+from file_manager import FileManager
+from message import LENGTH_STRUCT, Handshake, Message
+from peer import Peer
+from peer_manager import PeerManager
+from peerProcess import ConnectionHandler
+
+# Deterministic in-process swarm simulator, for trying choke and piece
+# selection policies on a big swarm without starting processes.
+#
+#   python simulator.py [--peers 1000] [--seed 1] [--set Key=Value ...]
+#
+# Every peer is a real PeerManager (choke rounds) with a FileManager that keeps
+# its bitfield in memory instead of a file, and every connection is a real
+# ConnectionHandler (message handling, interest counting, piece requests) that
+# is never started as a thread. Their sends go to the event queue instead of a
+# socket:
+#
+# - time is virtual, events run one at a time in (time, sequence) order, so a
+#   run only takes as long as the events take to process.
+# - control messages arrive `latency` seconds after they are sent, in order
+#   per connection (like TCP).
+# - a PIECE waits for the sender's upload link (one piece at a time, in the
+#   order they were asked for) and the receiver's download link.
+# - all randomness (topology, link classes and the module level random used by
+#   Bitfield and PeerManager) comes from one seed, the same arguments always
+#   give the same swarm and the same result.
+#
+# Peers are connected to about `degree` random others, all at time 0 (a flash
+# crowd). Super-seeding, PEX, the tracker, rate limits and timeouts are not
+# simulated.
+
+# (name, upload B/s, download B/s, share of the peers)
+LINK_CLASSES = (
+    ("dsl", 64 * 1024, 1024 * 1024, 0.4),
+    ("cable", 256 * 1024, 4 * 1024 * 1024, 0.4),
+    ("fiber", 2 * 1024 * 1024, 8 * 1024 * 1024, 0.2),
+)
+SEEDER_LINK = ("seeder", 2 * 1024 * 1024, 8 * 1024 * 1024)
+
+# Common.cfg used when --common is not given
+SIM_COMMON = {
+    "NumberOfPreferredNeighbors": "4",
+    "UnchokingInterval": "5",
+    "OptimisticUnchokingInterval": "15",
+    "FileName": "sim.dat",
+    "FileSize": str(4 * 1024 * 1024),
+    "PieceSize": str(64 * 1024),
+}
+
+FIRST_PEER_ID = 1001
+
+
+# FileManager without a file: pieces only set the bitfield, reads return
+# zeros of the right size. Piece selection and interest counting are the
+# ones of FileManager.
+class MemoryFileManager(FileManager):
+    def __init__(self, my_peer_info, common_config):
+        self.peer_id = my_peer_info.peer_id
+        self.file_name = common_config["FileName"]
+        self.file_size = int(common_config["FileSize"])
+        self.piece_size = int(common_config["PieceSize"])
+        self.num_pieces = math.ceil(self.file_size / self.piece_size)
+
+        self.piece_selection = common_config.get("PieceSelection", "random")
+        if self.piece_selection not in self.PIECE_SELECTIONS:
+            raise ValueError(f"Unknown piece selection: {self.piece_selection}")
+        self.sequential_window = int(common_config.get("SequentialWindow", 4))
+
+        self.bitfield = Bitfield(self.num_pieces)
+        self.have_count = [0]
+        self.file_lock = threading.Lock()
+        self.pending_pieces = set()
+        self.piece_added_hooks = []
+        self.seeding = False
+        self.seed_map = None
+
+        if my_peer_info.has_file:
+            self.bitfield.set_all()
+            self.num_pieces_have = self.num_pieces
+            self.seeding = True
+
+        self.content = bytes(self.piece_size)
+        self.last_content = bytes(
+            self.file_size - (self.num_pieces - 1) * self.piece_size
+        )
+
+    # "written" right away, on_written runs before this returns
+    def write_piece(self, piece_index, data, on_written=None):
+        with self.file_lock:
+            if (
+                self.bitfield.has_piece(piece_index)
+                or piece_index in self.pending_pieces
+            ):
+                return False
+            self.pending_pieces.add(piece_index)
+        self._on_piece_written((piece_index, on_written), True)
+        return True
+
+    def enter_seed_mode(self):
+        self.seeding = True
+
+    def read_piece(self, piece_index):
+        if piece_index == self.num_pieces - 1:
+            return self.last_content
+        return self.content
+
+    def close(self):
+        pass
+
+
+# PeerManager whose timers run on the simulator clock.
+class SimPeerManager(PeerManager):
+    def __init__(self, sim, my_peer_id, all_peers_info, file_manager, common_config):
+        super().__init__(my_peer_id, all_peers_info, file_manager, common_config)
+        self.sim = sim
+
+    def start_timers(self):
+        # peers do not start at the exact same moment
+        self.sim.schedule(
+            self.sim.rng.uniform(0, self.p_interval), self._preferred_round
+        )
+        self.sim.schedule(
+            self.sim.rng.uniform(0, self.m_interval), self._optimistic_round
+        )
+
+    def _preferred_round(self):
+        self.update_preferred_neighbors()
+        self.sim.schedule(self.p_interval, self._preferred_round)
+
+    def _optimistic_round(self):
+        self.update_optimistic_neighbor()
+        self.sim.schedule(self.m_interval, self._optimistic_round)
+
+    # everything runs on one thread here, no need to defer to the connections
+    def update_interest(self):
+        for handler in list(self.connections.values()):
+            handler.update_interest()
+
+    # same batching as _have_flusher, the delay is virtual
+    def broadcast_have(self, piece_index):
+        if self.have_batch_delay <= 0 or self.file_manager.is_complete():
+            batch = self.pending_haves + [piece_index]
+            self.pending_haves = []
+            self._send_haves(batch)
+            return
+        if not self.pending_haves:
+            self.sim.schedule(self.have_batch_delay, self._flush_haves)
+        self.pending_haves.append(piece_index)
+
+    def _flush_haves(self):
+        batch = self.pending_haves
+        self.pending_haves = []
+        if batch:
+            self._send_haves(batch)
+
+
+# One side of a simulated connection. Everything it sends is handed to the
+# simulator, which calls receive() on the other side when it arrives.
+class SimConnection(ConnectionHandler):
+
+    __slots__ = ("sim", "remote", "next_arrival")
+
+    def __init__(self, sim, peer, other_peer):
+        super().__init__(
+            None, peer.peer_id, peer.peer_manager, peer.file_manager, other_peer.peer_id
+        )
+        self.sim = sim
+        self.remote = None  # the SimConnection on the other side
+        self.next_arrival = 0.0  # keeps messages in order
+        self.start_time = sim.now
+        self.upload_start_time = sim.now
+
+    # The part of run() before the main loop: registration, the BITFIELD
+    # exchange and the first INTERESTED / NOT_INTERESTED.
+    def open(self, their_bitfield):
+        self.other_peer_id = self.expected_peer_id
+        self.extensions = Handshake.EXT_HAVE_BATCH
+        self.peer_manager.add_connection(self.other_peer_id, self)
+        with self.file_manager.file_lock:
+            self.their_bitfield = their_bitfield
+            self.num_interesting = self.file_manager.count_interesting(their_bitfield)
+        self.peer_manager.update_peer_bitfield(self.other_peer_id, their_bitfield)
+        with self.interest_lock:
+            self.am_interested_in_them = self.num_interesting > 0
+            if self.am_interested_in_them:
+                self._send(Message.INTERESTED_FRAME)
+            else:
+                self._send(Message.NOT_INTERESTED_FRAME)
+
+    # data holds one or more whole frames, sliced without copying
+    def receive(self, data):
+        data = memoryview(data)
+        offset = 0
+        while offset < len(data):
+            (msg_length,) = LENGTH_STRUCT.unpack_from(data, offset)
+            offset += 4
+            if msg_length == 0:
+                msg = Message(Message.KEEP_ALIVE)
+            else:
+                msg = Message(data[offset], data[offset + 1 : offset + msg_length])
+            offset += msg_length
+            self.handle_message(msg)
+
+    def get_download_rate(self):
+        duration = self.sim.now - self.start_time
+        if duration == 0:
+            return 0
+        rate = self.bytes_downloaded / duration
+        self.bytes_downloaded = 0
+        self.start_time = self.sim.now
+        return rate
+
+    def get_upload_rate(self):
+        duration = self.sim.now - self.upload_start_time
+        if duration == 0:
+            return 0
+        rate = self.bytes_uploaded / duration
+        self.bytes_uploaded = 0
+        self.upload_start_time = self.sim.now
+        return rate
+
+    def _send(self, data):
+        self.sim.send(self, data)
+
+    def _send_paced(self, data):
+        self.sim.send_piece(self, data)
+
+
+class SimPeer:
+    __slots__ = (
+        "peer_id",
+        "link",
+        "upload",
+        "download",
+        "is_seeder",
+        "file_manager",
+        "peer_manager",
+        "upload_free_at",
+        "download_free_at",
+        "uploaded",
+        "downloaded",
+        "completed_at",
+    )
+
+    def __init__(self, peer_id, link, is_seeder):
+        self.peer_id = peer_id
+        self.link, self.upload, self.download = link
+        self.is_seeder = is_seeder
+        self.file_manager = None
+        self.peer_manager = None
+        self.upload_free_at = 0.0
+        self.download_free_at = 0.0
+        self.uploaded = 0
+        self.downloaded = 0
+        self.completed_at = 0.0 if is_seeder else None
+
+
+class Simulator:
+    def __init__(
+        self,
+        common_config,
+        num_peers=1000,
+        num_seeders=1,
+        degree=10,
+        latency=0.05,
+        link_classes=LINK_CLASSES,
+        seed=1,
+    ):
+        if num_peers < 2 or not 0 < num_seeders < num_peers:
+            raise ValueError("Need at least one seeder and one leecher.")
+        self.latency = latency
+        self.now = 0.0
+        self.queue = []
+        self.sequence = itertools.count()
+        self.num_events = 0
+        self.num_messages = 0
+        self.rng = random.Random(seed)
+        random.seed(seed)
+
+        config = dict(common_config)
+        config["Pex"] = "0"
+        config["SuperSeeding"] = "0"
+        resolve_piece_size(config, num_peers)
+        self.config = config
+        self.num_pieces = math.ceil(int(config["FileSize"]) / int(config["PieceSize"]))
+
+        names = [link[:3] for link in link_classes]
+        weights = [link[3] for link in link_classes]
+        self.peers = {}
+        for i in range(num_peers):
+            peer_id = FIRST_PEER_ID + i
+            if i < num_seeders:
+                self.peers[peer_id] = SimPeer(peer_id, SEEDER_LINK, True)
+            else:
+                link = self.rng.choices(names, weights)[0]
+                self.peers[peer_id] = SimPeer(peer_id, link, False)
+        self.num_complete = num_seeders
+
+        neighbors = self._make_topology(degree)
+        with quiet():
+            for peer_id, peer in self.peers.items():
+                peer_info = Peer(peer_id, "sim", 0, peer.is_seeder)
+                neighbor_infos = [peer_info] + [
+                    Peer(other_id, "sim", 0, self.peers[other_id].is_seeder)
+                    for other_id in neighbors[peer_id]
+                ]
+                peer.file_manager = MemoryFileManager(peer_info, config)
+                peer.file_manager.piece_added_hooks.append(
+                    lambda piece_index, peer=peer: self._on_piece_added(peer)
+                )
+                peer.peer_manager = SimPeerManager(
+                    self, peer_id, neighbor_infos, peer.file_manager, config
+                )
+            for peer_id, other_ids in neighbors.items():
+                for other_id in other_ids:
+                    if other_id > peer_id:
+                        self._connect(self.peers[peer_id], self.peers[other_id])
+
+    # Every peer dials degree / 2 random others, so on average every peer
+    # ends up with about degree connections.
+    def _make_topology(self, degree):
+        peer_ids = list(self.peers)
+        neighbors = {peer_id: [] for peer_id in peer_ids}
+        dials = min(max(1, degree // 2), len(peer_ids) - 1)
+        for peer_id in peer_ids:
+            for other_id in self.rng.sample(peer_ids, dials + 1):
+                if other_id == peer_id or other_id in neighbors[peer_id]:
+                    continue
+                neighbors[peer_id].append(other_id)
+                neighbors[other_id].append(peer_id)
+        return neighbors
+
+    def _connect(self, peer, other_peer):
+        side = SimConnection(self, peer, other_peer)
+        other_side = SimConnection(self, other_peer, peer)
+        side.remote = other_side
+        other_side.remote = side
+        # the BITFIELD each side would receive
+        side.open(self._copy_bitfield(other_peer))
+        other_side.open(self._copy_bitfield(peer))
+
+    def _copy_bitfield(self, peer):
+        return Bitfield.from_bytes(
+            self.num_pieces, peer.file_manager.bitfield.to_bytes()
+        )
+
+    def _on_piece_added(self, peer):
+        if peer.completed_at is None and peer.file_manager.is_complete():
+            peer.completed_at = self.now
+            self.num_complete += 1
+
+    # --- event queue ---
+
+    def schedule(self, delay, callback, *args):
+        self.schedule_at(self.now + delay, callback, *args)
+
+    def schedule_at(self, at, callback, *args):
+        heapq.heappush(self.queue, (at, next(self.sequence), callback, args))
+
+    def _deliver(self, handler, at, data):
+        at = max(at, handler.next_arrival)
+        handler.next_arrival = at
+        self.num_messages += 1
+        self.schedule_at(at, handler.remote.receive, data)
+
+    def send(self, handler, data):
+        self._deliver(handler, self.now + self.latency, data)
+
+    # Store and forward: the piece leaves once the sender's upload link is
+    # free, and arrives once it also made it through the receiver's download
+    # link.
+    def send_piece(self, handler, data):
+        sender = self.peers[handler.my_peer_id]
+        receiver = self.peers[handler.other_peer_id]
+        size = len(data)
+        start = max(self.now, sender.upload_free_at)
+        sender.upload_free_at = start + size / sender.upload
+        arrival = max(
+            sender.upload_free_at + self.latency,
+            max(start, receiver.download_free_at) + size / receiver.download,
+        )
+        receiver.download_free_at = arrival
+        sender.uploaded += size
+        receiver.downloaded += size
+        self._deliver(handler, arrival, data)
+
+    # Runs until every peer has the file or max_time (virtual seconds) passed.
+    def run(self, max_time=3600):
+        wall_start = time.perf_counter()
+        with quiet():
+            for peer in self.peers.values():
+                peer.peer_manager.start_timers()
+            while self.queue and self.num_complete < len(self.peers):
+                at, _, callback, args = heapq.heappop(self.queue)
+                if at > max_time:
+                    break
+                self.now = at
+                callback(*args)
+                self.num_events += 1
+        return self.report(time.perf_counter() - wall_start)
+
+    # --- results ---
+
+    def report(self, wall_time):
+        leechers = [peer for peer in self.peers.values() if not peer.is_seeder]
+        times = sorted(
+            peer.completed_at for peer in leechers if peer.completed_at is not None
+        )
+        ratios = [
+            peer.uploaded / peer.downloaded for peer in leechers if peer.downloaded
+        ]
+        file_size = int(self.config["FileSize"])
+        seeders_uploaded = sum(
+            peer.uploaded for peer in self.peers.values() if peer.is_seeder
+        )
+
+        per_link = {}
+        for peer in leechers:
+            per_link.setdefault(peer.link, []).append(peer)
+
+        return {
+            "peers": len(self.peers),
+            "leechers": len(leechers),
+            "pieces": self.num_pieces,
+            "piece_size": int(self.config["PieceSize"]),
+            "completed": len(times),
+            "time": self.now,
+            "completion_mean": sum(times) / len(times) if times else None,
+            "completion_p50": percentile(times, 0.5),
+            "completion_p90": percentile(times, 0.9),
+            "completion_max": times[-1] if times else None,
+            "share_ratio_mean": sum(ratios) / len(ratios) if ratios else None,
+            "share_ratio_fairness": jain_index(ratios),
+            "seeder_copies": seeders_uploaded / file_size,
+            "per_link": {
+                link: {
+                    "peers": len(peers),
+                    "completion_mean": mean(
+                        [
+                            peer.completed_at
+                            for peer in peers
+                            if peer.completed_at is not None
+                        ]
+                    ),
+                    "share_ratio_mean": mean(
+                        [
+                            peer.uploaded / peer.downloaded
+                            for peer in peers
+                            if peer.downloaded
+                        ]
+                    ),
+                }
+                for link, peers in per_link.items()
+            },
+            "events": self.num_events,
+            "messages": self.num_messages,
+            "wall_time": wall_time,
+        }
+
+
+# the repo prints a line for almost everything, not wanted here
+@contextlib.contextmanager
+def quiet():
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def mean(values):
+    return sum(values) / len(values) if values else None
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[round(fraction * (len(sorted_values) - 1))]
+
+
+# Jain's fairness index: 1 when all values are equal, 1/n when one peer has
+# everything.
+def jain_index(values):
+    total = sum(values)
+    squares = sum(value * value for value in values)
+    if not values or squares == 0:
+        return None
+    return total * total / (len(values) * squares)
+
+
+def print_report(result):
+    def fmt(value, unit=""):
+        return "-" if value is None else f"{value:.2f}{unit}"
+
+    print(
+        f"{result['peers']} peers ({result['leechers']} leechers), "
+        f"{result['pieces']} pieces of {result['piece_size']} bytes"
+    )
+    print(
+        f"completed:     {result['completed']}/{result['leechers']} "
+        f"after {fmt(result['time'], 's')} (virtual)"
+    )
+    print(
+        f"completion:    mean {fmt(result['completion_mean'], 's')}, "
+        f"p50 {fmt(result['completion_p50'], 's')}, "
+        f"p90 {fmt(result['completion_p90'], 's')}, "
+        f"max {fmt(result['completion_max'], 's')}"
+    )
+    print(
+        f"share ratio:   mean {fmt(result['share_ratio_mean'])}, "
+        f"fairness (Jain) {fmt(result['share_ratio_fairness'])}"
+    )
+    print(f"seeder upload: {fmt(result['seeder_copies'])} copies of the file")
+    for link, stats in sorted(result["per_link"].items()):
+        print(
+            f"  {link:8} {stats['peers']:6} peers, "
+            f"completion mean {fmt(stats['completion_mean'], 's')}, "
+            f"share ratio mean {fmt(stats['share_ratio_mean'])}"
+        )
+    print(
+        f"{result['events']} events, {result['messages']} messages, "
+        f"{fmt(result['wall_time'], 's')} wall time"
+    )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Simulate a swarm on virtual time, see simulator.py."
+    )
+    parser.add_argument("--peers", type=int, default=1000)
+    parser.add_argument("--seeders", type=int, default=1)
+    parser.add_argument(
+        "--degree", type=int, default=10, help="average connections per peer"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.05, help="one way delay in seconds"
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--max-time", type=float, default=3600, help="virtual seconds before giving up"
+    )
+    parser.add_argument(
+        "--common", help="Common.cfg to start from (default: built in small file)"
+    )
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="override a Common.cfg key, e.g. --set PieceSelection=sequential",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    try:
+        common_config = (
+            read_common_config(args.common) if args.common else dict(SIM_COMMON)
+        )
+        for setting in args.set:
+            key, sep, value = setting.partition("=")
+            if not sep:
+                raise ConfigError(f"--set {setting}: expected KEY=VALUE.")
+            common_config[key] = value
+        validate_common_config(common_config, "simulator config")
+        sim = Simulator(
+            common_config,
+            args.peers,
+            args.seeders,
+            args.degree,
+            args.latency,
+            seed=args.seed,
+        )
+    except ValueError as e:
+        print(f"FATAL ERROR: {e}")
+        sys.exit(1)
+    print_report(sim.run(args.max_time))
@@ -0,0 +1,217 @@
+import random
+import threading
+import time
+from array import array
+
+from bitfield import Bitfield
+
+
+# Super-seeding for the initial seeder (SuperSeeding 1 in Common.cfg).
+#
+# Instead of a full BITFIELD the seeder sends an empty one and then offers
+# pieces with HAVE, at most SuperSeedOffers at a time per peer. Every offer is
+# the piece that has been offered the fewest times so far, so each piece goes
+# out once before any piece goes out twice. An offer is done (and replaced by
+# a new one) once the piece shows up at another peer (it was shared), or
+# nobody else needs it, or SuperSeedPatience seconds passed since we sent it.
+# (The peer itself will not HAVE the piece back to us, we announced it, see
+# send_haves.)
+#
+# Once every piece has been uploaded (or seen at a peer) at least once the
+# swarm no longer needs us as the only source: super-seeding ends and every
+# peer gets HAVEs for the rest of our pieces (they need our full bitfield to
+# terminate).
+class SuperSeeder:
+
+    CHECK_INTERVAL = 1.0
+
+    def __init__(self, peer_manager, file_manager, patience, window):
+        self.peer_manager = peer_manager
+        self.num_pieces = file_manager.num_pieces
+        self.patience = patience
+        self.window = max(1, window)
+        self.active = True
+        self.lock = threading.Lock()
+
+        self.offer_counts = array("I", [0] * self.num_pieces)
+        self.first_offered_to = {}  # piece index -> peer id
+        self.held = Bitfield(self.num_pieces)  # uploaded or seen at a peer
+        self.num_held = 0
+
+        # peer id -> {offered piece: time we sent it (or None)}
+        self.offers = {}
+        # peer id -> pieces announced to that peer
+        self.announced = {}
+
+    def start(self):
+        threading.Thread(target=self._patience_timer, daemon=True).start()
+
+    # After the BITFIELD exchange. sent_empty tells if the peer got our empty
+    # bitfield. If super-seeding ended since then the peer missed the final
+    # announcement (it was not registered yet) and gets every piece now.
+    def add_peer(self, handler, sent_empty=True):
+        with self.lock:
+            active = self.active
+            if active:
+                self.announced[handler.other_peer_id] = set()
+                self.offers[handler.other_peer_id] = {}
+                for piece_index in range(self.num_pieces):
+                    if handler.their_bitfield.has_piece(piece_index):
+                        self._set_held(piece_index)
+                to_offer = [(handler, self._fill_offers(handler))]
+        if active:
+            self._after_update(to_offer)
+        elif sent_empty:
+            handler.send_haves(list(range(self.num_pieces)), True)
+
+    def remove_peer(self, peer_id):
+        with self.lock:
+            self.offers.pop(peer_id, None)
+            self.announced.pop(peer_id, None)
+
+    # Their HAVE / HAVE_BATCH. A piece seen at a peer other than the one we
+    # first offered it to was shared, that peer gets a new offer.
+    def on_peer_has(self, handler, piece_indices):
+        to_offer = []
+        with self.lock:
+            if not self.active:
+                return
+            for piece_index in piece_indices:
+                self._set_held(piece_index)
+                first = self.first_offered_to.get(piece_index)
+                if first is None or first == handler.other_peer_id:
+                    continue
+                offers = self.offers.get(first)
+                if offers is not None and piece_index in offers:
+                    del offers[piece_index]
+                    first_handler = self.peer_manager.connections.get(first)
+                    if first_handler is not None:
+                        to_offer.append(
+                            (first_handler, self._fill_offers(first_handler))
+                        )
+        self._after_update(to_offer)
+
+    # We sent a piece: it is in the swarm now. The offer is done right away
+    # if nobody else could get the piece from the peer, otherwise the
+    # patience clock starts.
+    def on_piece_sent(self, handler, piece_index):
+        to_offer = []
+        with self.lock:
+            if not self.active:
+                return
+            self._set_held(piece_index)
+            offers = self.offers.get(handler.other_peer_id)
+            if (
+                offers is not None
+                and piece_index in offers
+                and offers[piece_index] is None
+            ):
+                if self._nobody_else_needs(handler, piece_index):
+                    del offers[piece_index]
+                    to_offer.append((handler, self._fill_offers(handler)))
+                else:
+                    offers[piece_index] = time.monotonic()
+        self._after_update(to_offer)
+
+    def _patience_timer(self):
+        while self.active and not self.peer_manager.shutdown_event.is_set():
+            time.sleep(self.CHECK_INTERVAL)
+            to_offer = []
+            now = time.monotonic()
+            with self.lock:
+                for peer_id, offers in self.offers.items():
+                    expired = [
+                        piece_index
+                        for piece_index, sent_at in offers.items()
+                        if sent_at is not None and now - sent_at >= self.patience
+                    ]
+                    handler = self.peer_manager.connections.get(peer_id)
+                    if not expired or handler is None:
+                        continue
+                    for piece_index in expired:
+                        del offers[piece_index]
+                    to_offer.append((handler, self._fill_offers(handler)))
+            self._after_update(to_offer)
+
+    # --- helpers, called with self.lock held ---
+
+    # Tops the peer up to self.window offers, returns the new pieces.
+    def _fill_offers(self, handler):
+        offers = self.offers.get(handler.other_peer_id)
+        new_pieces = []
+        while offers is not None and len(offers) < self.window:
+            piece_index = self._next_offer(handler)
+            if piece_index is None:
+                break
+            offers[piece_index] = None
+            new_pieces.append(piece_index)
+        return new_pieces
+
+    # Picks the least offered piece the peer does not have and records it.
+    def _next_offer(self, handler):
+        peer_id = handler.other_peer_id
+        announced = self.announced[peer_id]
+        candidates = []
+        lowest = None
+        for piece_index in range(self.num_pieces):
+            if handler.their_bitfield.has_piece(piece_index):
+                continue
+            if piece_index in announced:
+                continue
+            count = self.offer_counts[piece_index]
+            if lowest is None or count < lowest:
+                lowest = count
+                candidates = [piece_index]
+            elif count == lowest:
+                candidates.append(piece_index)
+        if not candidates:
+            return None
+
+        piece_index = random.choice(candidates)
+        self.offer_counts[piece_index] += 1
+        self.first_offered_to.setdefault(piece_index, peer_id)
+        announced.add(piece_index)
+        return piece_index
+
+    def _nobody_else_needs(self, handler, piece_index):
+        for peer_id, other in self.peer_manager.connections.items():
+            if peer_id != handler.other_peer_id and not other.their_bitfield.has_piece(
+                piece_index
+            ):
+                return False
+        return True
+
+    def _set_held(self, piece_index):
+        if not self.held.has_piece(piece_index):
+            self.held.set_piece(piece_index)
+            self.num_held += 1
+
+    # --- sends, outside the lock ---
+
+    def _after_update(self, offers):
+        for handler, piece_indices in offers:
+            if piece_indices:
+                handler.send_haves(piece_indices)
+
+        with self.lock:
+            if not self.active or self.num_held < self.num_pieces:
+                return
+            self.active = False
+            remaining = {
+                peer_id: [
+                    piece_index
+                    for piece_index in range(self.num_pieces)
+                    if piece_index not in announced
+                ]
+                for peer_id, announced in self.announced.items()
+            }
+            self.offers.clear()
+            self.announced.clear()
+
+        print(
+            f"[{self.peer_manager.my_peer_id}] Every piece is in the swarm, super-seeding done."
+        )
+        for peer_id, piece_indices in remaining.items():
+            handler = self.peer_manager.connections.get(peer_id)
+            if handler is not None and piece_indices:
+                handler.send_haves(piece_indices, True)
@@ -0,0 +1,121 @@
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Lightweight tracker for dynamic peer discovery (Tracker host:port in
+# Common.cfg), replaces the static PeerInfo.cfg.
+#
+#   python tracker.py [port] [interval]
+#
+# Peers announce themselves over HTTP:
+#
+#   GET /announce?peer_id=1001&port=6008&left=12&event=started
+#
+# event is started, completed, stopped or empty (periodic announce), left is
+# the number of pieces the peer is still missing. The answer is JSON with
+# every live member, the announcing peer included:
+#
+#   {"interval": 10,
+#    "peers": [{"peer_id": 1001, "ip": "...", "port": 6008, "complete": false}]}
+#
+# A member that does not announce for EXPIRE_INTERVALS intervals is dropped.
+
+DEFAULT_PORT = 6969
+DEFAULT_INTERVAL = 10
+
+
+class Tracker:
+
+    EXPIRE_INTERVALS = 3
+
+    def __init__(self, interval=DEFAULT_INTERVAL):
+        self.interval = interval
+        self.members = {}  # peer id -> {"ip", "port", "complete", "last_seen"}
+        self.lock = threading.Lock()
+
+    def announce(self, params, remote_ip):
+        peer_id = int(params["peer_id"])
+        event = params.get("event", "")
+        now = time.monotonic()
+        with self.lock:
+            if event == "stopped":
+                if self.members.pop(peer_id, None) is not None:
+                    print(f"[tracker] {peer_id} left.")
+            else:
+                if peer_id not in self.members:
+                    print(f"[tracker] {peer_id} joined.")
+                self.members[peer_id] = {
+                    "ip": params.get("ip", remote_ip),
+                    "port": int(params["port"]),
+                    "complete": int(params.get("left", 1)) == 0,
+                    "last_seen": now,
+                }
+            self._expire(now)
+            peers = [
+                {
+                    "peer_id": member_id,
+                    "ip": member["ip"],
+                    "port": member["port"],
+                    "complete": member["complete"],
+                }
+                for member_id, member in sorted(self.members.items())
+            ]
+        return {"interval": self.interval, "peers": peers}
+
+    def _expire(self, now):
+        max_age = self.EXPIRE_INTERVALS * self.interval
+        for peer_id, member in list(self.members.items()):
+            if now - member["last_seen"] > max_age:
+                del self.members[peer_id]
+                print(f"[tracker] {peer_id} timed out.")
+
+
+def make_handler(tracker):
+    class AnnounceHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path != "/announce":
+                self.send_error(404)
+                return
+            params = {key: values[0] for key, values in parse_qs(url.query).items()}
+            try:
+                body = json.dumps(tracker.announce(params, self.client_address[0]))
+            except (KeyError, ValueError) as e:
+                self.send_error(400, f"Bad announce: {e}")
+                return
+            data = body.encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass  # one line per announce is too noisy
+
+    return AnnounceHandler
+
+
+def serve(port=DEFAULT_PORT, interval=DEFAULT_INTERVAL):
+    tracker = Tracker(interval)
+    server = ThreadingHTTPServer(("0.0.0.0", port), make_handler(tracker))
+    print(f"[tracker] Listening on port {port}, announce interval {interval}s.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    try:
+        port = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_PORT
+        interval = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_INTERVAL
+    except ValueError:
+        print("Usage: python tracker.py [port] [interval]")
+        sys.exit(1)
+    serve(port, interval)
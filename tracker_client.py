@@ -0,0 +1,104 @@
+import json
+import threading
+import urllib.request
+from urllib.parse import urlencode
+
+from peer import Peer
+
+
+# Client side of tracker.py.
+#
+# start() announces us and returns once the first peer list is in (or the
+# tracker could not be reached). Afterwards we re-announce every interval the
+# tracker asks for, and right away when our download completes. on_update is
+# called with every peer list as on_update(peers, complete), where peers are
+# Peer objects (us excluded) and complete is the set of peer ids the tracker
+# saw with the complete file. stop() tells the tracker we leave.
+class TrackerClient:
+
+    TIMEOUT = 5
+    RETRY_INTERVAL = 5  # after a failed announce
+
+    def __init__(self, tracker_address, my_peer_info, file_manager, on_update):
+        self.url = f"http://{tracker_address}/announce"
+        self.my_peer_info = my_peer_info
+        self.file_manager = file_manager
+        self.on_update = on_update
+        self.interval = 10
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+        # one announce at a time, so "stopped" is always the last one
+        self.announce_lock = threading.Lock()
+        self.announced_complete = False
+        file_manager.piece_added_hooks.append(self._on_piece_added)
+
+    def start(self):
+        self._announce("started")
+        threading.Thread(target=self._announce_loop, daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+        self.wake.set()
+        self._announce("stopped")
+
+    # piece_added_hook, runs under file_manager.file_lock
+    def _on_piece_added(self, piece_index):
+        if self.file_manager.is_complete():
+            self.wake.set()
+
+    def _announce_loop(self):
+        while not self.stopped.is_set():
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            if self.stopped.is_set():
+                return
+            event = ""
+            if self.file_manager.is_complete() and not self.announced_complete:
+                event = "completed"
+            self._announce(event)
+
+    def _announce(self, event):
+        with self.announce_lock:
+            if event == "stopped" or not self.stopped.is_set():
+                self._send_announce(event)
+
+    def _send_announce(self, event):
+        left = self.file_manager.num_pieces - self.file_manager.num_pieces_have
+        query = {
+            "peer_id": self.my_peer_info.peer_id,
+            "port": self.my_peer_info.port,
+            "left": left,
+        }
+        if event:
+            query["event"] = event
+        try:
+            with urllib.request.urlopen(
+                f"{self.url}?{urlencode(query)}", timeout=self.TIMEOUT
+            ) as response:
+                answer = json.loads(response.read())
+        except (OSError, ValueError) as e:
+            print(f"[{self.my_peer_info.peer_id}] Tracker announce failed: {e}")
+            self.interval = self.RETRY_INTERVAL
+            return
+        if event == "stopped":
+            return
+        if left == 0:
+            self.announced_complete = True
+
+        self.interval = answer.get("interval", self.interval)
+        peers = []
+        complete = set()
+        for entry in answer.get("peers", []):
+            if entry["peer_id"] == self.my_peer_info.peer_id:
+                continue
+            peers.append(
+                Peer(
+                    entry["peer_id"],
+                    entry["ip"],
+                    entry["port"],
+                    int(entry["complete"]),
+                )
+            )
+            if entry["complete"]:
+                complete.add(entry["peer_id"])
+        self.on_update(peers, complete)